@@ -0,0 +1,198 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Data pipeline benchmarks, without a model."""
+
+import time
+import cv2
+import numpy as np
+
+from src import prepare_args
+from src.data import transform
+from src.data.dataset import create_mindrecord, create_detr_dataset, preprocess_fn
+
+
+def run_padding(args, mindrecord_file, aspect_grouping):
+    """iterate bench_steps batches, return imgs/sec and the mean padded pixels per image"""
+    args.aspect_grouping = aspect_grouping
+    ds = create_detr_dataset(args, mindrecord_file, batch_size=args.batch_size,
+                             num_parallel_workers=args.num_parallel_workers,
+                             python_multiprocessing=args.python_multiprocessing)
+    num_imgs = 0
+    num_pixels = 0
+    shapes = set()
+    start_time = time.time()
+    for i, data in enumerate(ds.create_dict_iterator(output_numpy=True, num_epochs=1)):
+        if i == args.bench_steps:
+            break
+        bs, _, h, w = data['image'].shape
+        num_imgs += bs
+        num_pixels += bs * h * w
+        shapes.add((h, w))
+    cost = time.time() - start_time
+    return num_imgs / cost, num_pixels / max(num_imgs, 1), shapes
+
+
+def run_transforms(args, arena, is_training):
+    """time preprocess_fn on synthetic 480x640 COCO-like samples (decode included if it runs in it), return ms/sample"""
+    rng = np.random.RandomState(args.seed)
+    image = rng.randint(0, 256, (480, 640, 3)).astype(np.uint8)
+    if args.reduced_decode or (is_training and args.crop_aware_decode):
+        # these decode inside preprocess_fn, the pipeline gives them the encoded jpeg
+        image = cv2.imencode('.jpg', image)[1]
+    xy = rng.rand(8, 2) * [320, 240]
+    annotation = np.concatenate([xy, xy + [200, 160], np.ones((8, 1)), np.zeros((8, 1))], axis=1).astype(np.int32)
+    image_id = np.array(1, dtype=np.int32)
+    for _ in range(5):
+        preprocess_fn(args, image_id, image, annotation, is_training, arena)
+    start_time = time.time()
+    for _ in range(args.bench_steps):
+        preprocess_fn(args, image_id, image, annotation, is_training, arena)
+    return (time.time() - start_time) * 1000 / args.bench_steps
+
+
+def bench_transforms(args):
+    print("\n========================================\n")
+    for is_training in (True, False):
+        fresh = run_transforms(args, None, is_training)
+        reused = run_transforms(args, transform.BufferArena(), is_training)
+        print(f'{"train" if is_training else "eval"} preprocess_fn: {fresh:.2f} ms/sample with fresh buffers, '
+              f'{reused:.2f} ms/sample with reused buffers')
+    print("\n========================================\n")
+
+
+def bench_padding(args):
+    if args.shape_buckets:
+        raise ValueError('the padding benchmark compares square padding with --aspect_grouping, '
+                         'without --shape_buckets')
+    mindrecord_file = create_mindrecord(args, 0, "DETR.mindrecord", True)
+
+    square_fps, square_pixels, _ = run_padding(args, mindrecord_file, False)
+    grouped_fps, grouped_pixels, shapes = run_padding(args, mindrecord_file, True)
+
+    print("\n========================================\n")
+    print(f'square padding : {square_fps:.2f} imgs/sec, {square_pixels:.0f} pixels/img')
+    print(f'grouped padding: {grouped_fps:.2f} imgs/sec, {grouped_pixels:.0f} pixels/img, '
+          f'{len(shapes)} batch shapes')
+    print(f'backbone/encoder input pixels relative to square padding: {grouped_pixels / square_pixels:.3f}')
+    print("\n========================================\n")
+
+
+def consume(ds, num_rows, step_ms=0.):
+    """
+    Iterate num_rows rows of ds, sleeping step_ms after each one like a model step would.
+    Return rows/sec, the fraction of rows the consumer had to wait more than 1 ms for (the
+    prefetch queue was empty) and the mean wait in ms. The first row, paying the pipeline
+    startup, is not counted.
+    """
+    waits = []
+    start_time = last_time = None
+    for i, _ in enumerate(ds.create_tuple_iterator(output_numpy=True, num_epochs=1)):
+        now = time.time()
+        if i == 0:
+            start_time = now
+        else:
+            waits.append(now - last_time)
+        if i == num_rows:
+            break
+        if step_ms:
+            time.sleep(step_ms / 1000)
+        last_time = time.time()
+    if not waits:
+        return 0., 0., 0.
+    waits = np.array(waits)
+    return len(waits) / (time.time() - start_time), float(np.mean(waits > 1e-3)), float(waits.mean() * 1000)
+
+
+def run_pipeline(args, mindrecord_file, is_training, stop_after=None):
+    """consume the (truncated) train or eval dataset, return samples/sec, starved fraction, mean wait"""
+    ds = create_detr_dataset(args, mindrecord_file, batch_size=args.batch_size, is_training=is_training,
+                             num_parallel_workers=args.num_parallel_workers,
+                             python_multiprocessing=args.python_multiprocessing, stop_after=stop_after)
+    if stop_after is None:
+        fps, starved, wait = consume(ds, args.bench_steps, args.bench_step_ms)
+        return fps * args.batch_size, starved, wait
+    return consume(ds, args.bench_steps * args.batch_size)
+
+
+def bench_stages(args, mindrecord_file, is_training):
+    """
+    Per-sample wall time added by each stage, from the throughput of the pipeline truncated after it,
+    and the parallel efficiency of the workers: samples/sec with num_parallel_workers workers
+    relative to num_parallel_workers times the samples/sec with a single worker.
+    """
+    name = "train" if is_training else "eval"
+    prev_ms = 0.
+    for stage in ('read', 'decode', 'transform', None):
+        fps, _, _ = run_pipeline(args, mindrecord_file, is_training, stage)
+        cur_ms = 1000 / max(fps, 1e-6)
+        print(f'{name} {stage or "batch"}: {fps:.1f} samples/sec, +{cur_ms - prev_ms:.2f} ms/sample')
+        prev_ms = cur_ms
+
+    num_workers = args.num_parallel_workers
+    parallel_fps, _, _ = run_pipeline(args, mindrecord_file, is_training, 'transform')
+    args.num_parallel_workers = 1
+    serial_fps, _, _ = run_pipeline(args, mindrecord_file, is_training, 'transform')
+    args.num_parallel_workers = num_workers
+    print(f'{name} worker efficiency with {num_workers} workers: '
+          f'{parallel_fps / max(num_workers * serial_fps, 1e-6):.2f}')
+
+
+def bench_pipeline(args):
+    """per-stage breakdown at the given configuration, then a sweep of the full pipelines"""
+    mindrecords = {
+        True: create_mindrecord(args, 0, "DETR.mindrecord", True),
+        False: create_mindrecord(args, 0, "DETR.mindrecord.eval", False),
+    }
+    print("\n========================================\n")
+    for is_training, mindrecord_file in mindrecords.items():
+        bench_stages(args, mindrecord_file, is_training)
+    print("\n========================================\n")
+
+    workers = [int(w) for w in args.bench_workers.split(',')]
+    prefetch = [int(p) for p in args.bench_prefetch.split(',')]
+    results = []
+    for is_training, mindrecord_file in mindrecords.items():
+        # python_multiprocessing is only used by the training map
+        for multiprocessing in ((False, True) if is_training else (False,)):
+            for num_workers in workers:
+                for prefetch_size in prefetch:
+                    args.num_parallel_workers = num_workers
+                    args.python_multiprocessing = multiprocessing
+                    args.prefetch_size = prefetch_size
+                    fps, starved, wait = run_pipeline(args, mindrecord_file, is_training)
+                    results.append((fps, is_training, multiprocessing, num_workers, prefetch_size))
+                    print(f'{"train" if is_training else "eval"} workers={num_workers} '
+                          f'multiprocessing={multiprocessing} prefetch={prefetch_size}: {fps:.1f} samples/sec, '
+                          f'starved {starved:.2f}, wait {wait:.2f} ms/batch')
+    print("\n========================================\n")
+    for is_training in mindrecords:
+        fps, _, multiprocessing, num_workers, prefetch_size = max(r for r in results if r[1] == is_training)
+        print(f'best {"train" if is_training else "eval"}: --num_parallel_workers {num_workers} '
+              f'{"--python_multiprocessing " if multiprocessing else ""}--prefetch_size {prefetch_size} '
+              f'({fps:.1f} samples/sec)')
+    print("\n========================================\n")
+
+
+def main():
+    args = prepare_args()
+    if args.bench == 'transforms':
+        bench_transforms(args)
+    elif args.bench == 'pipeline':
+        bench_pipeline(args)
+    else:
+        bench_padding(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Train step time in PYNATIVE_MODE and GRAPH_MODE, on synthetic batches."""
+
+import time
+import numpy as np
+import mindspore as ms
+import mindspore.nn as nn
+from mindspore import context, Tensor
+from mindspore.common import set_seed
+
+from src import prepare_args
+from src.DETR import build_model
+from src.tools.cell import WithLossCell, WithGradCell, WithGradCellGraph
+
+
+def synthetic_batch(args, data_dtype):
+    """a max_size x max_size batch with 8 boxes per image, targets padded to max_boxes"""
+    rng = np.random.RandomState(args.seed)
+    bs, size = args.batch_size, args.max_size
+    image = Tensor(rng.randn(bs, 3, size, size), data_dtype)
+    mask = Tensor(np.zeros((bs, size, size)), data_dtype)
+    boxes = np.zeros((bs, args.max_boxes, 4), np.float32)
+    boxes[:, :8] = np.concatenate([rng.rand(bs, 8, 2) * 0.6 + 0.2, rng.rand(bs, 8, 2) * 0.2 + 0.05], axis=-1)
+    labels = np.full((bs, args.max_boxes), -1, np.int32)
+    labels[:, :8] = rng.randint(1, args.num_classes, (bs, 8))
+    valid = np.zeros((bs, args.max_boxes), np.bool_)
+    valid[:, :8] = True
+    return image, mask, Tensor(boxes), Tensor(labels), Tensor(valid)
+
+
+def run(args, graph_mode):
+    """return the first step time (compilation included) and the following step times, in seconds"""
+    args.graph_mode = graph_mode
+    context.set_context(mode=context.GRAPH_MODE if graph_mode else context.PYNATIVE_MODE,
+                        device_target=args.device_target, device_id=args.device_id)
+    set_seed(args.seed)
+
+    net, criterion, _ = build_model(args)
+    data_dtype = ms.float32
+    if args.device_target == 'Ascend':
+        net.to_float(ms.float16)
+        for _, cell in net.cells_and_names():
+            if isinstance(cell, (nn.BatchNorm2d, nn.LayerNorm)):
+                cell.to_float(ms.float32)
+        data_dtype = ms.float16
+    net.set_train()
+    optimizer = nn.AdamWeightDecay(net.trainable_params(), learning_rate=args.lr, weight_decay=args.weight_decay)
+    grad_cell = WithGradCellGraph if graph_mode else WithGradCell
+    net_with_grad = grad_cell(WithLossCell(net, criterion), optimizer, clip_value=args.clip_max_norm)
+
+    batch = synthetic_batch(args, data_dtype)
+    start_time = time.time()
+    net_with_grad(*batch).asnumpy()
+    first_step = time.time() - start_time
+    steps = []
+    for _ in range(args.bench_steps):
+        start_time = time.time()
+        net_with_grad(*batch).asnumpy()
+        steps.append(time.time() - start_time)
+    return first_step, np.array(steps)
+
+
+def main():
+    args = prepare_args()
+    results = {name: run(args, graph_mode) for name, graph_mode in (('pynative', False), ('graph', True))}
+
+    print("\n========================================\n")
+    for name, (first_step, steps) in results.items():
+        print(f'{name:8s}: first step {first_step:.2f}s, step {steps.mean() * 1000:.1f} ms '
+              f'(median {np.median(steps) * 1000:.1f} ms), {args.batch_size / steps.mean():.2f} imgs/sec')
+    speedup = results['pynative'][1].mean() / results['graph'][1].mean()
+    print(f'graph mode speedup: {speedup:.2f}x')
+    print("\n========================================\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -24,14 +24,15 @@ from mindspore import ops
 from mindspore import context, Tensor
 from mindspore.train.serialization import load_checkpoint, load_param_into_net
 
-from pycocotools.coco import COCO
-
 from src import prepare_args
 from src.data.coco_eval import CocoEvaluator
+from src.data.coco_index import load_coco_index
 from src.DETR.util import box_cxcywh_to_xyxy
 from src.data.dataset import create_mindrecord, create_detr_dataset
+from src.data.eval_cache import create_eval_cache_dataset
 from src.DETR.backbone import build_backbone
 from src.DETR.detr import build_transformer, DETR
+from src.tools.tracer import Tracer, parse_trace_steps, set_tracer, span
 
 
 def load_ckpt(weights_path):
@@ -56,7 +57,8 @@ def build_net(args):
         transformer,
         num_classes=num_classes,
         num_queries=args.num_queries,
-        aux_loss=args.aux_loss
+        aux_loss=args.aux_loss,
+        normalize_input=args.uint8_input
     )
     return model
 
@@ -80,52 +82,74 @@ def evaluation():
                 cell.to_float(ms.float32)
 
     mindrecord_file = create_mindrecord(args, 0, "DETR.mindrecord.eval", False)
-    ds = create_detr_dataset(args, mindrecord_file, batch_size=16,
-                             device_num=1, rank_id=0,
-                             num_parallel_workers=args.num_parallel_workers,
-                             python_multiprocessing=args.python_multiprocessing,
-                             is_training=False)
+    if args.eval_cache_dir:
+        ds = create_eval_cache_dataset(args, mindrecord_file, args.eval_cache_dir, batch_size=16,
+                                       num_parallel_workers=args.num_parallel_workers)
+    else:
+        ds = create_detr_dataset(args, mindrecord_file, batch_size=16,
+                                 device_num=1, rank_id=0,
+                                 num_parallel_workers=args.num_parallel_workers,
+                                 python_multiprocessing=args.python_multiprocessing,
+                                 is_training=False)
     total = ds.get_dataset_size()
 
     anno_json = os.path.join(args.coco_path, "annotations/instances_{}.json".format(args.val_data_type))
-    coco_gt = COCO(anno_json)
+    coco_gt = load_coco_index(anno_json, args.mindrecord_dir).to_coco()
     coco_evaluator = CocoEvaluator(coco_gt, ('bbox', ))
 
     print("\n========================================\n")
     print("total images num: ", total)
     print("Processing, please wait a moment.")
+    # the selected batches, then the COCO evaluation
+    tracer = Tracer(args.trace_file, *parse_trace_steps(args), args.trace_profiler) if args.trace_steps else None
+    set_tracer(tracer)
     start = time.time()
     results = []
-    for data in tqdm(ds.create_dict_iterator(output_numpy=True)):
+    end_time = time.time()
+    for i, data in enumerate(tqdm(ds.create_dict_iterator(output_numpy=True))):
+        start_time = time.time()
+        if tracer is not None:
+            tracer.step(i)
+            tracer.add('data_wait', 'data', end_time, start_time)
         # image, mask, image_id, ori_size = data
-        image = Tensor(data['image'], ms.float16)
+        image = Tensor(data['image']) if args.uint8_input else Tensor(data['image'], ms.float16)
         mask = Tensor(data['mask'], ms.float16)
         ori_size = Tensor(data['ori_size'])
         image_id = data['image_id']
 
-        out_logits, out_bbox = net(image, mask)
+        with span('forward', 'eval'):
+            out_logits, out_bbox = net(image, mask)
 
-        prob = ops.Softmax()(out_logits)
-        labels, scores = ops.ArgMaxWithValue(axis=-1)(prob[..., :-1])
-        boxes = box_cxcywh_to_xyxy(out_bbox)
-        img_h, img_w = ops.Unstack(axis=1)(ori_size)
-        scale_fct = ops.Stack(axis=1)([img_w, img_h, img_w, img_h])
-        boxes = boxes * scale_fct[:, None, :]
+        with span('postprocess', 'eval'):
+            prob = ops.Softmax()(out_logits)
+            labels, scores = ops.ArgMaxWithValue(axis=-1)(prob[..., :-1])
+            boxes = box_cxcywh_to_xyxy(out_bbox)
+            img_h, img_w = ops.Unstack(axis=1)(ori_size)
+            scale_fct = ops.Stack(axis=1)([img_w, img_h, img_w, img_h])
+            boxes = boxes * scale_fct[:, None, :]
 
         results.append((image_id, (scores, labels, boxes)))
+        end_time = time.time()
         # results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
         # res = {idx: output for idx, output in zip(image_id, results)}
         # coco_evaluator.update(res)
         # coco_evaluator.graph_update(image_id, scores, labels, boxes)
 
-    for image_id, (scores, labels, boxes) in results:
-        res = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
-        img_res = {idx: output for idx, output in zip(image_id, res)}
-        coco_evaluator.update(img_res)
-
-    coco_evaluator.synchronize_between_processes()
-    coco_evaluator.accumulate()
-    coco_evaluator.summarize()
+    if tracer is not None:
+        tracer.begin()
+    with span('coco_update', 'coco_eval'):
+        for image_id, (scores, labels, boxes) in results:
+            res = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
+            img_res = {idx: output for idx, output in zip(image_id, res)}
+            coco_evaluator.update(img_res)
+
+    with span('coco_accumulate', 'coco_eval'):
+        coco_evaluator.synchronize_between_processes()
+        coco_evaluator.accumulate()
+    with span('coco_summarize', 'coco_eval'):
+        coco_evaluator.summarize()
+    if tracer is not None:
+        tracer.close()
     print(coco_evaluator.coco_eval.get('bbox').stats)
     print('cost time: ', time.time() - start)
     print("\n========================================\n")
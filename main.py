@@ -15,26 +15,71 @@
 
 import os
 import time
-from collections import deque
+import numpy as np
 import mindspore as ms
 import mindspore.nn as nn
-from mindspore import context
+from mindspore import context, Tensor
 from mindspore.communication.management import init
 from mindspore.context import ParallelMode
 from mindspore import load_checkpoint, load_param_into_net
 from mindspore.common import set_seed
+from mindspore.train import Model
+import mindspore.dataset.transforms as T
 
 from src import prepare_args
 from src.DETR import build_model
-from src.data.dataset import create_mindrecord, create_detr_dataset
-from src.tools.cell import WithLossCell, WithGradCell
+from src.data.dataset import create_mindrecord, create_detr_dataset, parse_shape_buckets, map_keep_size
+from src.data.autotune import DataAutoTuner
+from src.tools.cell import WithLossCell, WithGradCell, WithGradCellGraph
 from src.tools.average_meter import AverageMeter
+from src.tools.callbacks import SinkMonitor, EpochCheckpoint
+from src.tools.checkpoint import AsyncCheckpointWriter, CheckpointRetention
+from src.tools.timer import PhaseTimer, set_timer
+from src.tools.tracer import Tracer, parse_trace_steps, set_tracer
+
+
+def warmup_shape_buckets(net_with_grad, buckets, batch_size, max_boxes, data_dtype, image_dtype):
+    """compile and cache the train graphs of every shape bucket before step 0, targets padded to max_boxes"""
+    gt_boxes = np.zeros((batch_size, max_boxes, 4), np.float32)
+    gt_boxes[:, 0] = [0.5, 0.5, 0.2, 0.2]
+    gt_labels = np.full((batch_size, max_boxes), -1, np.int32)
+    gt_labels[:, 0] = 1
+    gt_valid = np.zeros((batch_size, max_boxes), np.bool_)
+    gt_valid[:, 0] = True
+    for h, w in buckets:
+        start_time = time.time()
+        net_with_grad.warmup(Tensor(np.zeros((batch_size, 3, h, w)), image_dtype),
+                             Tensor(np.zeros((batch_size, h, w)), data_dtype),
+                             Tensor(gt_boxes), Tensor(gt_labels), Tensor(gt_valid))
+        print(f'compile shape bucket {h}x{w}: {time.time() - start_time:.2f}s', flush=True)
+
+
+def create_train_dataset(args, mindrecord_file, device_num, rank, epoch, skip_steps=0):
+    """train dataset of one epoch, without its first skip_steps batches"""
+    return create_detr_dataset(args, mindrecord_file, batch_size=args.batch_size,
+                               device_num=device_num, rank_id=rank,
+                               num_parallel_workers=args.num_parallel_workers,
+                               python_multiprocessing=args.python_multiprocessing,
+                               epoch=epoch, skip_samples=skip_steps * args.batch_size)
 
 
 def main():
     args = prepare_args()
 
-    context.set_context(mode=context.PYNATIVE_MODE, device_target=args.device_target)
+    if args.aspect_grouping and args.shape_buckets:
+        raise ValueError('--aspect_grouping and --shape_buckets are two ways of grouping the batches, choose one')
+    if args.sink_size and (args.aspect_grouping or args.shape_buckets):
+        # the device queue of the data sink takes batches of one fixed shape
+        raise ValueError('--sink_size can not be combined with --aspect_grouping or --shape_buckets')
+    if args.sink_size and not args.graph_mode:
+        print('data sink training runs in graph mode, --graph_mode is turned on')
+        args.graph_mode = True
+    if args.graph_mode and args.packed_targets:
+        # a compiled graph needs fixed target shapes
+        print('--packed_targets is ignored in graph mode, the targets are padded to max_boxes')
+        args.packed_targets = False
+    context.set_context(mode=context.GRAPH_MODE if args.graph_mode else context.PYNATIVE_MODE,
+                        device_target=args.device_target)
 
     # init seed
     set_seed(args.seed)
@@ -59,22 +104,31 @@ def main():
         device_num = 1
         context.set_context(device_id=args.device_id)
 
-    # dataset
-    mindrecord_file = create_mindrecord(args, rank, "DETR.mindrecord", True)
-    dataset = create_detr_dataset(args, mindrecord_file, batch_size=args.batch_size,
-                                  device_num=device_num, rank_id=rank,
-                                  num_parallel_workers=args.num_parallel_workers,
-                                  python_multiprocessing=args.python_multiprocessing)
+    # a full training state checkpoint restarts at its epoch and step
+    ckpt = load_checkpoint(args.resume) if args.resume else {}
+    resume_step = 0
+    full_state = 'epoch' in ckpt
+    if full_state:
+        args.start_epoch = int(ckpt.pop('epoch').asnumpy())
+        resume_step = int(ckpt.pop('step').asnumpy())
+        if args.sink_size and resume_step:
+            print(f'data sink training resumes at the start of epoch {args.start_epoch}')
+            resume_step = 0
+        print(f'resume training state at epoch {args.start_epoch}, step {resume_step}')
+
+    # dataset, rebuilt every epoch with the order of that epoch,
+    # a resumed epoch skips its consumed samples before decoding
+    mindrecord_file = None if args.stream_source else create_mindrecord(args, rank, "DETR.mindrecord", True)
+    dataset = create_train_dataset(args, mindrecord_file, device_num, rank, args.start_epoch, resume_step)
     # dataset = build_dataset()
-    dataset_size = dataset.get_dataset_size()
+    dataset_size = dataset.get_dataset_size() + resume_step
     print("Create COCO dataset done!")
     print(f"COCO dataset num: {dataset_size}")
 
     # model
     net, criterion, postprocessors = build_model(args)
     # load pretrained weights
-    if args.resume:
-        ckpt = load_checkpoint(args.resume)
+    if ckpt and not full_state:
         if 'net' in list(ckpt.keys())[0]:
             ckpt = {k[4:]: v for k, v in ckpt.items()}
         load_param_into_net(net, ckpt, strict_load=True)
@@ -89,15 +143,12 @@ def main():
         data_dtype = ms.float16
     net.set_train()
 
-    # lr and optimizer
-    lr = nn.piecewise_constant_lr(
-        [dataset_size * args.lr_drop, dataset_size * args.epochs],
-        [args.lr, args.lr * 0.1]
-    )
-    lr_backbone = nn.piecewise_constant_lr(
-        [dataset_size * args.lr_drop, dataset_size * args.epochs],
-        [args.lr_backbone, args.lr_backbone * 0.1]
-    )
+    # lr and optimizer, the lr steps are optimizer updates: one per accumulation_steps batches
+    accumulation_steps = args.accumulation_steps
+    lr_steps = [dataset_size * args.lr_drop // accumulation_steps,
+                -(-dataset_size * args.epochs // accumulation_steps)]
+    lr = nn.piecewise_constant_lr(lr_steps, [args.lr, args.lr * 0.1])
+    lr_backbone = nn.piecewise_constant_lr(lr_steps, [args.lr_backbone, args.lr_backbone * 0.1])
     backbone_params = list(filter(lambda x: 'backbone' in x.name, net.trainable_params()))
     no_backbone_params = list(filter(lambda x: 'backbone' not in x.name, net.trainable_params()))
     param_dicts = [
@@ -108,25 +159,91 @@ def main():
 
     # init mindspore model
     net_with_loss = WithLossCell(net, criterion)
-    net_with_grad = WithGradCell(net_with_loss, optimizer, clip_value=args.clip_max_norm)
+    grad_cell = WithGradCellGraph if args.graph_mode else WithGradCell
+    loss_scale_manager = None
+    if args.loss_scale == 'dynamic':
+        loss_scale_manager = nn.DynamicLossScaleUpdateCell(loss_scale_value=args.loss_scale_init,
+                                                           scale_factor=args.loss_scale_factor,
+                                                           scale_window=args.loss_scale_window)
+    net_with_grad = grad_cell(net_with_loss, optimizer, clip_value=args.clip_max_norm,
+                              accumulation_steps=accumulation_steps, loss_scale_manager=loss_scale_manager)
+    if full_state:
+        # weights, optimizer moments and global step (the lr position), accumulated gradients
+        load_param_into_net(net_with_grad, ckpt, strict_load=True)
+        print('load training state checkpoint')
     print("Create DETR network done!")
 
+    if args.shape_buckets:
+        image_dtype = ms.uint8 if args.uint8_input else data_dtype
+        warmup_shape_buckets(net_with_grad, parse_shape_buckets(args), args.batch_size, args.max_boxes,
+                             data_dtype, image_dtype)
+
+    # rank 0 writes the epoch checkpoints in the background, the last 4 are kept
+    ckpt_writer = AsyncCheckpointWriter(on_commit=CheckpointRetention(keep_num=4)) if rank == 0 else None
+
+    if args.sink_size:
+        # the casts of the training loop run in the pipeline, the batches go through the device queue
+        cast_columns = ["mask"] if args.uint8_input else ["image", "mask"]
+        for column in cast_columns:
+            dataset = map_keep_size(dataset, operations=T.TypeCast(data_dtype), input_columns=[column])
+        callbacks = [SinkMonitor(args.batch_size, args.sink_size, dataset_size, args.start_epoch, args.epochs,
+                                 lr, lr_backbone, accumulation_steps,
+                                 net_with_grad if loss_scale_manager is not None else None)]
+        if rank == 0:
+            callbacks.append(EpochCheckpoint(net_with_grad, ckpt_writer, args.sink_size, dataset_size,
+                                             args.start_epoch))
+        model = Model(net_with_grad)
+        model.train((args.epochs - args.start_epoch) * dataset_size // args.sink_size, dataset,
+                    callbacks=callbacks, dataset_sink_mode=True, sink_size=args.sink_size)
+        if ckpt_writer is not None:
+            ckpt_writer.close()
+        return
+
     # callbacks
     loss_meter = AverageMeter()
-    ckpt_deque = deque()
-    data_loader = dataset.create_dict_iterator()
+    tuner = DataAutoTuner(args, device_num, args.autotune_steps) if args.autotune else None
+    timer = PhaseTimer(args.phase_window, args.phase_sync) if args.phase_timing else None
+    set_timer(timer)
+    tracer = Tracer(args.trace_file, *parse_trace_steps(args), args.trace_profiler) if args.trace_steps else None
+    set_tracer(tracer)
     for e in range(args.start_epoch, args.epochs):
-        for i, data in enumerate(data_loader):
+        skip_steps = resume_step if e == args.start_epoch else 0
+        data_loader = dataset.create_dict_iterator(num_epochs=1)
+        end_time = time.time()
+        for i, data in enumerate(data_loader, start=skip_steps):
             start_time = time.time()
-            img_data = data['image'].astype(data_dtype)
+            wait_time = start_time - end_time
+            if tracer is not None:
+                tracer.step(e * dataset_size + i)
+                tracer.add('data_wait', 'data', end_time, start_time)
+            if timer is not None:
+                timer.begin()
+                timer.add('data_wait', wait_time)
+                # the host batch is copied by the first device ops using it, the casts
+                timer.switch('h2d')
+            # uint8 images are normalized on device by the network
+            img_data = data['image'] if args.uint8_input else data['image'].astype(data_dtype)
             mask = data['mask'].astype(data_dtype)
             boxes = data['boxes']
             labels = data['labels']
-            valid = data['valid']
+            valid = data['num_boxes'] if args.packed_targets else data['valid']
+            if timer is not None:
+                # in PYNATIVE_MODE the train cell splits 'step' into its phases
+                timer.switch('step', mask)
             loss = net_with_grad(img_data, mask, boxes, labels, valid)
 
+            if timer is not None:
+                timer.switch('sync')
             loss_meter.update(loss.asnumpy())
             end_time = time.time()
+            if timer is not None:
+                timer.end()
+            if tracer is not None:
+                tracer.add('step', 'train', start_time, end_time, epoch=e, step=i)
+                if e * dataset_size + i + 1 >= tracer.end:
+                    tracer.close()
+            if tuner is not None:
+                tuner.update(wait_time, end_time - start_time)
 
             if i % (dataset_size//50) == 0:
                 fps = args.batch_size / (end_time - start_time)
@@ -135,16 +252,34 @@ def main():
                     i, dataset_size,
                     loss_meter.average(),
                     fps,
-                    lr_backbone[e * dataset_size + i], lr[e * dataset_size + i]
+                    lr_backbone[(e * dataset_size + i) // accumulation_steps],
+                    lr[(e * dataset_size + i) // accumulation_steps]
                 ), flush=True)
+                if loss_scale_manager is not None:
+                    print('loss scale:{}, overflow steps:{}'.format(
+                        float(net_with_grad.scale_sense.asnumpy()), int(net_with_grad.overflow_steps.asnumpy())
+                    ), flush=True)
+                if timer is not None:
+                    print(f'phase ms p50/p90: {timer.format()}', flush=True)
+                    if rank == 0:
+                        timer.dump(os.path.join('./outputs', 'phase_times.jsonl'), epoch=e, step=i)
+            if rank == 0 and args.save_every_steps and (i + 1) % args.save_every_steps == 0:
+                ckpt_writer.save(net_with_grad, os.path.join('./outputs', 'detr_last.ckpt'),
+                                 append_dict={'epoch': e, 'step': i + 1}, notify=False)
         loss_meter.reset()
         if rank == 0:
             ckpt_path = os.path.join('./outputs', f'detr_epoch_{e}.ckpt')
-            ms.save_checkpoint(net, ckpt_path)
-            if len(ckpt_deque) > 3:
-                pre_ckpt_path = ckpt_deque.popleft()
-                os.remove(pre_ckpt_path)
-            ckpt_deque.append(ckpt_path)
+            ckpt_writer.save(net_with_grad, ckpt_path, append_dict={'epoch': e + 1, 'step': 0})
+        if e + 1 < args.epochs:
+            if tuner is not None:
+                # the tuned pipeline starts with the next epoch
+                tuner.apply(tuner.propose())
+                tuner = None
+            dataset = create_train_dataset(args, mindrecord_file, device_num, rank, e + 1)
+    if tracer is not None:
+        tracer.close()
+    if ckpt_writer is not None:
+        ckpt_writer.close()
 
 
 if __name__ == '__main__':
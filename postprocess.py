@@ -20,14 +20,16 @@ import os
 import argparse
 import numpy as np
 from tqdm import tqdm
-from pycocotools.coco import COCO
 from src.data.coco_eval import CocoEvaluator
+from src.data.coco_index import load_coco_index
 
 
 def prepare_args():
     parser = argparse.ArgumentParser(description="postprocess")
     parser.add_argument("--result_dir", type=str, default="./result_Files", help="result files path.")
     parser.add_argument('--anno_path', type=str)
+    parser.add_argument('--anno_cache_dir', type=str, default='',
+                        help='where the annotation index is cached, defaults to the directory of anno_path')
     args = parser.parse_args()
     return args
 
@@ -46,8 +48,9 @@ def box_cxcywh_to_xyxy(boxes):
 
 
 def call_map(args):
-    coco_gt = COCO(args.anno_path)
-    img_ids = coco_gt.getImgIds()
+    index = load_coco_index(args.anno_path, args.anno_cache_dir)
+    coco_gt = index.to_coco()
+    img_ids = index.image_ids.tolist()
     coco_evaluator = CocoEvaluator(coco_gt, ('bbox',))
 
     print("\n========================================\n")
@@ -68,8 +71,7 @@ def call_map(args):
         bs_idx = np.arange(prob.shape[0])
         scores = prob[bs_idx, labels]
 
-        img_h = coco_gt.loadImgs(img_id)[0]['height']
-        img_w = coco_gt.loadImgs(img_id)[0]['width']
+        img_h, img_w = index.image_size(img_id)
         boxes = box_cxcywh_to_xyxy(out_bbox)
         scale_fct = np.array([img_w, img_h, img_w, img_h])
         boxes = boxes * scale_fct
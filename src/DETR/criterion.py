@@ -128,6 +128,7 @@ class SetCriterion(nn.Cell):
             gt_boxes: (bs, num_queries)
             gt_labels: (bs, num_queries, 4)
             gt_isvalid: (bs, num_queries) [True, True, False, False ......]
+            or packed (--packed_targets): gt_boxes (N, 4), gt_labels (N,), gt_isvalid: boxes per image (bs,)
         """
         if not self.aux_loss:
             return self.calculate_loss(pred_logits, pred_boxes, gt_boxes, gt_labels, gt_valids)
@@ -16,9 +16,12 @@ DETR model and criterion classes.
 # limitations under the License.
 # ============================================================================
 
+import numpy as np
 from mindspore import nn
 from mindspore import ops
+from mindspore import Tensor
 from mindspore import ms_function
+from mindspore import dtype as mstype
 from mindspore.common import initializer as init
 
 from src.DETR.init_weights import KaimingUniform, UniformBias
@@ -46,9 +49,30 @@ class MLP(nn.Cell):
         return self.layers(x)
 
 
+class InputNormalize(nn.Cell):
+    """
+    (x / 255 - mean) / std of uint8 images, computed on device in the dtype of the mask.
+    The padded pixels (mask 1) stay 0, as in the images normalized by the pipeline.
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super().__init__()
+        mean = np.array(mean, np.float32).reshape(1, 3, 1, 1)
+        std = np.array(std, np.float32).reshape(1, 3, 1, 1)
+        self.scale = Tensor(1 / (255 * std), mstype.float32)
+        self.shift = Tensor(-mean / std, mstype.float32)
+        self.cast = ops.Cast()
+        self.expand_dims = ops.ExpandDims()
+
+    def construct(self, x, mask):
+        dtype = mask.dtype
+        x = self.cast(x, dtype)
+        x = x * self.cast(self.scale, dtype) + self.cast(self.shift, dtype)
+        return x * (1 - self.expand_dims(mask, 1))
+
+
 class DETR(nn.Cell):
     """ This is the DETR module that performs object detection """
-    def __init__(self, backbone, transformer, num_classes, num_queries, aux_loss=True):
+    def __init__(self, backbone, transformer, num_classes, num_queries, aux_loss=True, normalize_input=False):
         super().__init__()
         self.num_queries = num_queries
         self.transformer = transformer
@@ -65,11 +89,15 @@ class DETR(nn.Cell):
         self.sigmoid = nn.Sigmoid()
         self.aux_loss = aux_loss
         self.cast = ops.Cast()
+        self.normalize_input = normalize_input
+        if normalize_input:
+            self.input_normalize = InputNormalize()
 
     @ms_function
     def construct(self, x, mask):
         """
             tensor: batched images, of shape [batch_size x 3 x H x W]
+                    (raw uint8 pixels when the model is built with normalize_input)
             mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
 
             It returns a dict with the following elements:
@@ -82,6 +110,8 @@ class DETR(nn.Cell):
                - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
                                 dictionnaries containing the two above keys for each decoder layer.
         """
+        if self.normalize_input:
+            x = self.input_normalize(x, mask)
         src, mask, pos = self.backbone(x, mask)
 
         query_embed = self.query_embed.embedding_table
@@ -163,7 +193,8 @@ def build(args):
         transformer,
         num_classes=num_classes,
         num_queries=args.num_queries,
-        aux_loss=args.aux_loss
+        aux_loss=args.aux_loss,
+        normalize_input=args.uint8_input
     )
 
     matcher = build_matcher(args)
@@ -0,0 +1,152 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Numpy Hungarian matching of the predictions with the targets, shared by the matcher cells."""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+from src.tools.tracer import traced
+
+
+def softmax(arr, axis=None):
+    """softmax"""
+    return np.exp(arr) / np.sum(np.exp(arr), axis=axis, keepdims=True)
+
+
+def box_xyxy_to_cxcywh(x):
+    """box xyxy to cxcywh"""
+    x0, y0, x1, y1 = np.array_split(x.T, 4)
+    b = [(x0 + x1) / 2, (y0 + y1) / 2,
+         (x1 - x0), (y1 - y0)]
+    return np.stack(b, axis=-1)[0]
+
+
+def box_cxcywh_to_xyxy(x):
+    """box cxcywh to xyxy"""
+    x_c, y_c, w, h = np.array_split(x, 4, axis=-1)
+    b = [(x_c - 0.5 * w), (y_c - 0.5 * h),
+         (x_c + 0.5 * w), (y_c + 0.5 * h)]
+    return np.stack(b, axis=-1).squeeze(-2)
+
+
+def GIOU(boxes1, boxes2):
+    """
+    boxes1 shape : shape (n, 4)
+    boxes2 shape : shape (k, 4)
+    gious: shape (n, k)
+    """
+    IOU = []
+    GIOU = []
+    num = (boxes1[:, 0]).size
+    x1 = boxes1[:, 0]
+    y1 = boxes1[:, 1]
+    x2 = boxes1[:, 2]
+    y2 = boxes1[:, 3]
+
+    xx1 = boxes2[:, 0]
+    yy1 = boxes2[:, 1]
+    xx2 = boxes2[:, 2]
+    yy2 = boxes2[:, 3]
+
+    area1 = (x2 - x1) * (y2 - y1)  # 求取框的面积
+    area2 = (xx2 - xx1) * (yy2 - yy1)
+    for i in range(num):
+        inter_max_x = np.minimum(x2[i], xx2[:])  # 求取重合的坐标及面积
+        inter_max_y = np.minimum(y2[i], yy2[:])
+        inter_min_x = np.maximum(x1[i], xx1[:])
+        inter_min_y = np.maximum(y1[i], yy1[:])
+        inter_w = np.maximum(0, inter_max_x - inter_min_x)
+        inter_h = np.maximum(0, inter_max_y - inter_min_y)
+
+        inter_areas = inter_w * inter_h
+
+        out_max_x = np.maximum(x2[i], xx2[:])  # 求取包裹两个框的集合C的坐标及面积
+        out_max_y = np.maximum(y2[i], yy2[:])
+        out_min_x = np.minimum(x1[i], xx1[:])
+        out_min_y = np.minimum(y1[i], yy1[:])
+        out_w = np.maximum(0, out_max_x - out_min_x)
+        out_h = np.maximum(0, out_max_y - out_min_y)
+
+        outer_areas = out_w * out_h
+        union = area1[i] + area2[:] - inter_areas  # 两框的总面积   利用广播机制
+        ious = inter_areas / union
+        gious = ious - (outer_areas - union) / outer_areas  # IOU - ((C\union）/C)
+        IOU.append(ious)
+        GIOU.append(gious)
+    return np.stack(GIOU, axis=0)
+
+
+@traced('matcher', 'train')
+def hungarian_match(pred_logits, pred_boxes, tgt_bbox, tgt_labels, tgt_valid, cost_class, cost_bbox, cost_giou):
+    """
+    numpy matching of HungarianMatcherNumpy, on numpy arrays
+    :return: target_classes (bs, num_queries) int32, target_boxes (bs, num_queries, 4) float32,
+             boxes_valid (bs, num_queries) float32
+    """
+    tgt_bbox = tgt_bbox.astype(np.float32)
+    tgt_labels = tgt_labels.astype(np.int32)
+
+    bs, num_queries, num_classes = pred_logits.shape
+
+    # We reshape to compute the cost matrices in a batch
+    # out_prob [batch_size * num_queries, num_classes]
+    out_prob = softmax(pred_logits.reshape(-1, pred_logits.shape[-1]), -1)
+    # out_bbox [batch_size * num_queries, 4]
+    out_bbox = pred_boxes.reshape(-1, pred_boxes.shape[-1])
+
+    # Also concat the target labels and boxes
+    if tgt_bbox.ndim == 2:
+        num_boxes = tgt_valid.astype(np.int64)
+        tgt_labels_valid = tgt_labels
+        tgt_bbox_valid = tgt_bbox
+    else:
+        tgt_valid = tgt_valid.astype(np.bool_)
+        num_boxes = tgt_valid.sum(1)
+        tgt_labels_valid = tgt_labels[tgt_valid]
+        tgt_bbox_valid = tgt_bbox[tgt_valid]
+    offsets = np.concatenate([[0], np.cumsum(num_boxes)])
+
+    # Compute the classification cost. Contrary to the loss, we don't use the NLL,
+    # but approximate it in 1 - proba[target class].
+    # The 1 is a constant that doesn't change the matching, it can be omitted.
+    class_cost = -out_prob[:, tgt_labels_valid]
+
+    # Compute the L1 cost between boxes
+    bbox_cost = cdist(out_bbox, tgt_bbox_valid, metric='minkowski', p=1)
+
+    # Compute the giou cost between boxes
+    giou_cost = -GIOU(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox_valid))
+
+    # Final cost matrix
+    C = cost_bbox * bbox_cost + cost_class * class_cost + cost_giou * giou_cost
+    C = C.reshape(bs, num_queries, -1)
+
+    indices = [linear_sum_assignment(c[i]) for i, c in enumerate(np.split(C, offsets[1:], -1)[:-1])]
+    src_idx = np.concatenate([src for (src, _) in indices])
+    col_idx = np.concatenate([col for (_, col) in indices])
+    batch_idx = np.concatenate([np.full_like(src, i) for i, (src, _) in enumerate(indices)])
+    # matched rows of the concatenated targets
+    tgt_idx = offsets[batch_idx] + col_idx
+
+    target_classes = np.ones((bs, num_queries)) * (num_classes - 1)  # 91
+    target_classes[batch_idx, src_idx] = tgt_labels_valid[tgt_idx]
+
+    target_boxes = np.zeros((bs, num_queries, 4))
+    target_boxes[batch_idx, src_idx] = tgt_bbox_valid[tgt_idx]
+
+    boxes_valid = np.zeros((bs, num_queries))
+    boxes_valid[batch_idx, src_idx] = 1
+
+    return target_classes.astype(np.int32), target_boxes.astype(np.float32), boxes_valid.astype(np.float32)
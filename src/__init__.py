@@ -25,10 +25,25 @@ def prepare_args():
     parser.add_argument('--lr_drop', default=200, type=int)
     parser.add_argument('--weight_decay', default=1e-4, type=float)
     parser.add_argument('--clip_max_norm', default=0.1, type=float, help='gradient clipping max norm')
+    parser.add_argument('--accumulation_steps', default=1, type=int,
+                        help='Number of batches whose gradients are accumulated on device before one clip, '
+                             'all-reduce and optimizer update. The effective batch size is multiplied by it')
+    parser.add_argument('--loss_scale', default='none', choices=['none', 'dynamic'],
+                        help='dynamic: loss scaling for float16 training, the steps whose gradients overflow '
+                             'are skipped and the scale is halved, it doubles after loss_scale_window '
+                             'steps without overflow')
+    parser.add_argument('--loss_scale_init', default=2 ** 12, type=float)
+    parser.add_argument('--loss_scale_factor', default=2, type=float)
+    parser.add_argument('--loss_scale_window', default=1000, type=int)
     parser.add_argument('--batch_size', default=4, type=int)
     parser.add_argument('--start_epoch', default=0, type=int, help='start epoch')
     parser.add_argument('--epochs', default=300, type=int)
-    parser.add_argument('--resume', default='', type=str, help='resume from checkpoint')
+    parser.add_argument('--resume', default='', type=str,
+                        help='resume from checkpoint: the weights, or the full training state '
+                             '(optimizer, step, epoch and data position) of a checkpoint written by main.py')
+    parser.add_argument('--save_every_steps', default=0, type=int,
+                        help='Write the full training state to outputs/detr_last.ckpt every N steps, '
+                             '0 writes it only at the end of the epochs')
     parser.add_argument('--pretrained', default='', type=str, help='resnet_backbone_ckpt')
     parser.add_argument('--seed', default=42, type=int)
 
@@ -40,18 +55,94 @@ def prepare_args():
     parser.add_argument('--dataset_file', default='coco')
     parser.add_argument('--mindrecord_dir', default='data')
     parser.add_argument('--coco_path', type=str)
+    parser.add_argument('--mindrecord_shards', default=8, type=int, help='Number of MindRecord shard files')
+    parser.add_argument('--resize_mindrecord', action='store_true',
+                        help='Store images in the MindRecord downscaled to the largest size the augmentation '
+                             'can request for max_size, with their original size for exact annotations')
+    parser.add_argument('--mindrecord_append', action='store_true',
+                        help='Convert the annotated images that are not in the MindRecord dataset yet into new '
+                             'shards, next to the existing ones')
+    parser.add_argument('--mindrecord_workers', default=8, type=int,
+                        help='Number of processes writing MindRecord shards in parallel')
     parser.add_argument('--train_data_type', default='train2017')
     parser.add_argument('--val_data_type', default='val2017')
     parser.add_argument('--num_classes', default=91, type=int, help='90(object) + 1(background)')
+    parser.add_argument('--stream_source', default='', type=str,
+                        help='Train without MindRecord conversion: "folder" streams the COCO image folder, '
+                             'a glob (e.g. "/data/coco-train-*.tar") streams WebDataset style tar shards')
+    parser.add_argument('--stream_shuffle_buffer', default=1000, type=int,
+                        help='Number of samples of the shuffle buffer of the streamed dataset')
+    parser.add_argument('--eval_cache_dir', default='', type=str,
+                        help='Directory of the memory-mapped resized eval images, built on first use. '
+                             'Empty to decode and resize the eval images on every run')
     parser.add_argument('--output_dir', default='', help='path where to save, empty for no saving')
     parser.add_argument('--num_parallel_workers', default=8, type=int,
                         help='Number of threads used to process the dataset in parallel')
     parser.add_argument('--python_multiprocessing', action='store_true',
                         help='Parallelize Python operations with multiple worker processes')
+    parser.add_argument('--max_rowsize', default=0, type=int,
+                        help='Shared memory slot size in MB between the python_multiprocessing workers and the '
+                             'pipeline, 0 to fit a max_size x max_size sample')
+    parser.add_argument('--reader_workers', default=0, type=int,
+                        help='Number of MindRecord reader threads, 0 for num_parallel_workers')
+    parser.add_argument('--prefetch_size', default=8, type=int,
+                        help='Queue capacity between the dataset pipeline ops')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Measure the batch waits of the first autotune_steps steps of the first epoch and '
+                             'rebuild the train dataset with tuned workers and prefetch size from the next epoch')
+    parser.add_argument('--autotune_steps', default=100, type=int, help='Number of steps measured by autotune')
 
     # image processing
     parser.add_argument('--max_size', default=960, type=int)
     parser.add_argument('--flip_ratio', default=0.5, type=float, help='random flip ratio')
+    parser.add_argument('--reduced_decode', action='store_true',
+                        help='Decode jpegs in the python transforms at the smallest DCT scale (1/2, 1/4, 1/8) '
+                             'that still covers the resize target')
+    parser.add_argument('--crop_aware_decode', action='store_true',
+                        help='Plan the training flip/resize/crop on the jpeg header, decode only at the scale '
+                             'the output needs and resample the source window once')
+    parser.add_argument('--uint8_input', action='store_true',
+                        help='Keep images uint8 in the data pipeline and normalize them on device')
+    parser.add_argument('--reuse_buffers', action='store_true',
+                        help='Pad (and normalize) every sample into a reusable per worker CHW buffer')
+    parser.add_argument('--aspect_grouping', action='store_true',
+                        help='Batch images by aspect ratio and pad each batch to its largest member '
+                             '(not with --shape_buckets)')
+    parser.add_argument('--pad_stride', default=128, type=int,
+                        help='Padded sizes are rounded up to a multiple of this when aspect_grouping is on')
+    parser.add_argument('--max_boxes', default=100, type=int,
+                        help='Maximum number of boxes kept per training image, the others are dropped with a warning')
+    parser.add_argument('--packed_targets', action='store_true',
+                        help='Batch the targets as flat boxes and labels with per image box counts instead of '
+                             'padding every image to max_boxes')
+    parser.add_argument('--shape_buckets', default='', type=str,
+                        help='Comma separated HxW training shapes, e.g. "640x960,960x640,800x800". Every sample '
+                             'is padded to the smallest bucket that holds it and the graphs of all buckets are '
+                             'compiled before training. (max_size)x(max_size) is always added')
+
+    # * Training mode
+    parser.add_argument('--graph_mode', action='store_true',
+                        help='Train in GRAPH_MODE, with the matcher as a host op, instead of PYNATIVE_MODE. '
+                             'Targets are padded to max_boxes')
+    parser.add_argument('--sink_size', default=0, type=int,
+                        help='Data sink training: feed the batches through the device queue and run sink_size '
+                             'steps per host call with Model.train (implies --graph_mode, needs fixed batch '
+                             'shapes, so not with --aspect_grouping or --shape_buckets). '
+                             '0 for the python training loop')
+    parser.add_argument('--phase_timing', action='store_true',
+                        help='Record the time of the phases of the python loop steps (data wait, h2d, forward, '
+                             'matcher, loss, backward, clip_reduce, optimizer, sync), log their p50/p90 and '
+                             'append their percentiles to outputs/phase_times.jsonl')
+    parser.add_argument('--phase_sync', action='store_true',
+                        help='Wait for the device at each phase boundary, for device times of the phases')
+    parser.add_argument('--phase_window', default=100, type=int, help='steps of the phase time percentiles')
+    parser.add_argument('--trace_steps', default='', type=str,
+                        help="'start,end': write the host spans of steps start to end - 1 (global training "
+                             "steps, eval batches) to --trace_file as a Chrome trace. Empty to disable")
+    parser.add_argument('--trace_file', default='./outputs/trace.json', type=str)
+    parser.add_argument('--trace_profiler', default='', type=str,
+                        help='Also run the MindSpore Profiler over the traced steps, with this output directory, '
+                             'and add its device timeline to the trace')
 
     # * Backbone
     parser.add_argument('--backbone', default='resnet50', type=str,
@@ -90,6 +181,20 @@ def prepare_args():
     parser.add_argument('--eos_coef', default=0.1, type=float,
                         help="Relative classification weight of the no-object class")
 
+    # benchmark
+    parser.add_argument('--bench', default='padding', choices=['padding', 'transforms', 'pipeline'],
+                        help='padding: square vs grouped padding throughput, '
+                             'transforms: per-sample preprocess_fn time with fresh vs reused buffers, '
+                             'pipeline: per-stage time, worker efficiency and starvation of the train/eval '
+                             'datasets, swept over workers, python_multiprocessing and prefetch size')
+    parser.add_argument('--bench_steps', default=100, type=int, help='Number of batches per benchmark run')
+    parser.add_argument('--bench_workers', default='2,4,8', type=str,
+                        help='Comma separated num_parallel_workers values swept by the pipeline benchmark')
+    parser.add_argument('--bench_prefetch', default='2,8,16', type=str,
+                        help='Comma separated prefetch sizes swept by the pipeline benchmark')
+    parser.add_argument('--bench_step_ms', default=0., type=float,
+                        help='Simulated model step time of the pipeline benchmark consumer, in ms')
+
     # distributed switch
     parser.add_argument("--distributed", default=0, type=int, help="is distributed")
 
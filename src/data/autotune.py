@@ -0,0 +1,112 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tuning of the data pipeline workers and prefetch size from the waits of the training loop."""
+
+import os
+import numpy as np
+
+from src.data.dataset import sample_bytes
+
+
+def cpu_budget(device_num):
+    """number of cpus of this rank"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus // device_num)
+
+
+def memory_budget(device_num, fraction=0.25):
+    """bytes of the available memory this rank may spend on pipeline queues, None if unknown"""
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return available * fraction / device_num
+
+
+class DataAutoTuner(object):
+    """
+    Watch how long the training loop waits for its batches during num_steps steps
+    (after skip_steps warmup steps) and propose the pipeline configuration of the next epochs.
+
+    The wait is the time from the end of a step to the arrival of the next batch. When the waits
+    are more than wait_threshold of the loop time the pipeline is the bottleneck, and the map and
+    reader workers are scaled by the throughput the model needs, within the cpus of the rank.
+    Bursty waits (the prefetch queue drains and refills) double the prefetch size, within the
+    memory budget of the rank.
+    """
+    def __init__(self, args, device_num=1, num_steps=100, skip_steps=5, wait_threshold=0.05):
+        self.args = args
+        self.device_num = device_num
+        self.num_steps = num_steps
+        self.skip_steps = skip_steps
+        self.wait_threshold = wait_threshold
+        self.config = {
+            'num_parallel_workers': args.num_parallel_workers,
+            'reader_workers': args.reader_workers or args.num_parallel_workers,
+            'prefetch_size': args.prefetch_size,
+        }
+        self.count = 0
+        self.waits = []
+        self.steps = []
+
+    @property
+    def done(self):
+        return len(self.waits) >= self.num_steps
+
+    def update(self, wait, step):
+        """record the wait for a batch and the time of the step on it"""
+        self.count += 1
+        if self.count > self.skip_steps and not self.done:
+            self.waits.append(wait)
+            self.steps.append(step)
+
+    def propose(self):
+        """the tuned configuration, the current one if too few steps were recorded"""
+        config = dict(self.config)
+        if not self.waits:
+            return config
+        waits = np.array(self.waits)
+        steps = np.array(self.steps)
+        wait_ratio = waits.sum() / (waits.sum() + steps.sum())
+        cpus = cpu_budget(self.device_num)
+        print(f'autotune: {len(waits)} steps, wait {waits.mean() * 1000:.2f} ms/step '
+              f'(p90 {np.percentile(waits, 90) * 1000:.2f} ms), step {steps.mean() * 1000:.2f} ms, '
+              f'wait ratio {wait_ratio:.3f}, {cpus} cpus', flush=True)
+
+        if wait_ratio > self.wait_threshold:
+            # the pipeline delivers a batch every wait + step, the model needs one every step
+            speedup = (waits.mean() + steps.mean()) / max(steps.mean(), 1e-6)
+            workers = int(np.ceil(config['num_parallel_workers'] * speedup * 1.2))
+            config['num_parallel_workers'] = max(config['num_parallel_workers'], min(cpus, workers))
+            reader_workers = int(np.ceil(config['reader_workers'] * speedup))
+            config['reader_workers'] = max(config['reader_workers'], min(cpus, reader_workers))
+            if np.percentile(waits, 90) > 2 * max(np.median(waits), 1e-3):
+                config['prefetch_size'] *= 2
+
+        budget = memory_budget(self.device_num)
+        if budget is not None:
+            # every map worker and each connector queue can hold prefetch_size samples
+            max_prefetch = int(budget // (sample_bytes(self.args) * (config['num_parallel_workers'] + 3)))
+            config['prefetch_size'] = max(1, min(config['prefetch_size'], max_prefetch))
+        return config
+
+    def apply(self, config):
+        """set config on args, log the flags that pin it"""
+        for key, value in config.items():
+            setattr(self.args, key, value)
+        self.config = dict(config)
+        print('autotune: pin with ' + ' '.join(f'--{key} {value}' for key, value in config.items()), flush=True)
@@ -0,0 +1,182 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Columnar COCO annotation index, cached as npz next to the data."""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def file_hash(path, chunk_size=1 << 24):
+    """sha1 of the file content"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def tmp_name(path):
+    """temporary name of path for this process, the ranks of a distributed run may write it at once"""
+    return f'{path}.{os.getpid()}.tmp'
+
+
+def cached_file_hash(path, stat_file):
+    """
+    file_hash of path, hashed again only when its size or mtime differ from the ones
+    recorded in stat_file with the last hash
+    """
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+        with open(stat_file, 'r') as f:
+            recorded = json.load(f)
+        if {name: recorded.get(name) for name in key} == key:
+            return recorded['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1 = file_hash(path)
+    try:
+        tmp_path = tmp_name(stat_file)
+        with open(tmp_path, 'w') as f:
+            json.dump({**key, 'sha1': sha1}, f)
+        os.replace(tmp_path, stat_file)
+    except OSError:
+        pass
+    return sha1
+
+
+class CocoIndex(object):
+    """
+    COCO instances annotations stored as flat numpy columns.
+
+    Images keep the order of the json file. The annotations of image i are
+    rows ann_offsets[i]:ann_offsets[i + 1] of the annotation columns, in json order.
+    """
+    FIELDS = ('image_ids', 'file_names', 'heights', 'widths', 'ann_offsets',
+              'ann_ids', 'bboxes', 'areas', 'category_ids', 'iscrowd', 'cat_ids', 'cat_names')
+
+    def __init__(self, **columns):
+        for name in self.FIELDS:
+            setattr(self, name, columns[name])
+        self._rows = None
+
+    @classmethod
+    def from_json(cls, anno_json):
+        with open(anno_json, 'r') as f:
+            dataset = json.load(f)
+
+        images = dataset['images']
+        image_ids = np.array([img['id'] for img in images], dtype=np.int64)
+        rows = {img_id: i for i, img_id in enumerate(image_ids.tolist())}
+
+        annos = dataset.get('annotations', [])
+        ann_rows = np.array([rows[ann['image_id']] for ann in annos], dtype=np.int64)
+        # stable sort keeps the json order of the annotations of each image
+        order = np.argsort(ann_rows, kind='stable')
+        annos = [annos[i] for i in order]
+
+        categories = dataset.get('categories', [])
+        return cls(
+            image_ids=image_ids,
+            file_names=np.array([img['file_name'] for img in images]),
+            heights=np.array([img['height'] for img in images], dtype=np.int32),
+            widths=np.array([img['width'] for img in images], dtype=np.int32),
+            ann_offsets=np.concatenate([[0], np.cumsum(np.bincount(ann_rows, minlength=len(images)))]),
+            ann_ids=np.array([ann['id'] for ann in annos], dtype=np.int64),
+            bboxes=np.array([ann['bbox'] for ann in annos], dtype=np.float64).reshape(-1, 4),
+            areas=np.array([ann['area'] for ann in annos], dtype=np.float64),
+            category_ids=np.array([ann['category_id'] for ann in annos], dtype=np.int32),
+            iscrowd=np.array([ann['iscrowd'] for ann in annos], dtype=np.int32),
+            cat_ids=np.array([cat['id'] for cat in categories], dtype=np.int32),
+            cat_names=np.array([cat['name'] for cat in categories]),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(**{name: data[name] for name in cls.FIELDS})
+
+    def save(self, path):
+        tmp_path = tmp_name(path)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def row(self, img_id):
+        """row of an image id"""
+        if self._rows is None:
+            self._rows = {img_id: i for i, img_id in enumerate(self.image_ids.tolist())}
+        return self._rows[img_id]
+
+    def image_size(self, img_id):
+        """(height, width) of an image id"""
+        i = self.row(img_id)
+        return int(self.heights[i]), int(self.widths[i])
+
+    def annotations(self, i):
+        """slice of the annotation columns belonging to image row i"""
+        return slice(self.ann_offsets[i], self.ann_offsets[i + 1])
+
+    def to_coco(self):
+        """build a pycocotools COCO object (e.g. as evaluation ground truth) without parsing the json"""
+        from pycocotools.coco import COCO
+
+        image_ids = self.image_ids.tolist()
+        ann_image_ids = np.repeat(self.image_ids, np.diff(self.ann_offsets)).tolist()
+        dataset = {
+            'images': [{'id': img_id, 'file_name': file_name, 'height': h, 'width': w}
+                       for img_id, file_name, h, w in zip(image_ids, self.file_names.tolist(),
+                                                          self.heights.tolist(), self.widths.tolist())],
+            'annotations': [{'id': ann_id, 'image_id': img_id, 'bbox': bbox, 'area': area,
+                             'category_id': cat_id, 'iscrowd': iscrowd}
+                            for ann_id, img_id, bbox, area, cat_id, iscrowd in zip(
+                                self.ann_ids.tolist(), ann_image_ids, self.bboxes.tolist(), self.areas.tolist(),
+                                self.category_ids.tolist(), self.iscrowd.tolist())],
+            'categories': [{'id': cat_id, 'name': name}
+                           for cat_id, name in zip(self.cat_ids.tolist(), self.cat_names.tolist())],
+        }
+        coco = COCO()
+        coco.dataset = dataset
+        coco.createIndex()
+        return coco
+
+
+def load_coco_index(anno_json, cache_dir=None):
+    """
+    Load the annotation index of anno_json, keyed by the hash of the json file.
+    It is parsed and cached in cache_dir (default: next to the json) the first time.
+    The hash is recorded with the size and mtime of the json, which are checked instead
+    of hashing it again.
+    """
+    cache_dir = cache_dir or os.path.dirname(anno_json)
+    name = os.path.splitext(os.path.basename(anno_json))[0]
+    sha1 = cached_file_hash(anno_json, os.path.join(cache_dir, f'{name}.stat.json'))
+    cache_file = os.path.join(cache_dir, f'{name}.{sha1[:16]}.npz')
+    if os.path.exists(cache_file):
+        return CocoIndex.load(cache_file)
+
+    print(f'Build annotation index of {anno_json}. It may take some time.')
+    index = CocoIndex.from_json(anno_json)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(cache_file)
+        print(f'Annotation index cached at {cache_file}')
+    except OSError as e:
+        print(f'Can not cache the annotation index at {cache_file}: {e}')
+    return index
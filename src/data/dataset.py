@@ -17,6 +17,9 @@
 from __future__ import division
 
 import os
+import json
+import time
+import multiprocessing
 import numpy as np
 
 import cv2
@@ -24,6 +27,9 @@ import mindspore.dataset as de
 import mindspore.dataset.vision as C
 from mindspore.mindrecord import FileWriter
 from src.data import transform
+from src.data.coco_index import load_coco_index
+from src.data.stream import CocoStream
+from src.tools.tracer import traced
 
 coco_classes = ['background', 'person', 'bicycle', 'car', 'motorcycle',
                 'airplane', 'bus', 'train', 'truck', 'boat',
@@ -59,11 +65,28 @@ coco_id_dict = {0: 'background', 1: 'person', 2: 'bicycle', 3: 'car', 4: 'motorc
                 87: 'scissors', 88: 'teddy bear', 89: 'hair drier', 90: 'toothbrush'}
 coco_cls_dict = {v: k for k, v in coco_id_dict.items()}
 
+DETR_SCHEMA = {
+    "image_id": {"type": "int32"},
+    "image": {"type": "bytes"},
+    "annotation": {"type": "int32", "shape": [-1, 6]},
+}
+MINDRECORD_ROWS_PER_WRITE = 64
+
+# training scales, the short sides of the resize before RandomSizeCrop, and the eval scale
+TRAIN_SCALES = [480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800]
+CROP_RESIZE_SIZES = [400, 500, 600]
+EVAL_SIZE = 800
+
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+
+# w / h boundaries of the aspect ratio groups used by grouped batching
+ASPECT_RATIO_BINS = [0.5, 1.0, 2.0]
+TARGET_PAD_INFO = {"boxes": (None, 0), "labels": (None, -1), "valid": (None, 0)}
+
 
 def create_coco_label(args, is_training):
     """Get image path and annotation from COCO."""
-    from pycocotools.coco import COCO
-
     coco_root = args.coco_path
     data_type = args.val_data_type
     if is_training:
@@ -75,86 +98,236 @@ def create_coco_label(args, is_training):
 
     anno_json = os.path.join(coco_root, "annotations/instances_{}.json".format(data_type))
 
-    coco = COCO(anno_json)
-    classes_dict = {}
-    cat_ids = coco.loadCats(coco.getCatIds())
-    for cat in cat_ids:
-        classes_dict[cat["id"]] = cat["name"]
+    index = load_coco_index(anno_json, args.mindrecord_dir)
+    # category id -> train label, -1 for the classes that are not trained
+    label_table = np.full(max(index.cat_ids.max(initial=0), index.category_ids.max(initial=0)) + 1, -1, np.int64)
+    for cat_id, class_name in zip(index.cat_ids.tolist(), index.cat_names.tolist()):
+        if class_name in train_cls:
+            label_table[cat_id] = train_cls_dict[class_name]
+    ann_labels = label_table[index.category_ids]
 
-    image_ids = coco.getImgIds()
     image_valid_ids = []
     image_anno_dict = {}
     image_files_dict = {}
 
-    for img_id in image_ids:
-        image_info = coco.loadImgs(img_id)
-        file_name = image_info[0]["file_name"]
-        anno_ids = coco.getAnnIds(imgIds=img_id, iscrowd=None)
-        anno = coco.loadAnns(anno_ids)
+    for i, (img_id, file_name) in enumerate(zip(index.image_ids.tolist(), index.file_names.tolist())):
         image_path = os.path.join(coco_root, data_type, file_name)
-        annos = []
-        for label in anno:
-            bbox = label["bbox"]
-            class_name = classes_dict[label["category_id"]]
-            if class_name in train_cls:
-                x1, x2 = bbox[0], bbox[0] + bbox[2]
-                y1, y2 = bbox[1], bbox[1] + bbox[3]
-                annos.append([x1, y1, x2, y2] + [train_cls_dict[class_name]] + [int(label["iscrowd"])])
+        anns = index.annotations(i)
+        keep = ann_labels[anns] >= 0
+        bbox = index.bboxes[anns][keep]
+        annos = np.concatenate([bbox[:, :2], bbox[:, :2] + bbox[:, 2:],
+                                ann_labels[anns][keep, None], index.iscrowd[anns][keep, None]], axis=1)
 
         if is_training:
-            if annos:
+            if annos.size:
                 image_valid_ids.append(img_id)
                 image_files_dict[img_id] = image_path
-                image_anno_dict[image_path] = np.array(annos)
+                image_anno_dict[image_path] = annos
             else:
                 print(f'{img_id} no annotations')
         else:
             image_valid_ids.append(img_id)
             image_files_dict[img_id] = image_path
-            if annos:
-                image_anno_dict[image_path] = np.array(annos)
+            if annos.size:
+                image_anno_dict[image_path] = annos
             else:
                 image_anno_dict[image_path] = np.array([0, 0, 0, 0, 0, 1])
 
     return image_valid_ids, image_files_dict, image_anno_dict
 
 
-def data_to_mindrecord_byte_image(args, prefix="DETR.mindrecord", is_training=True, file_num=8):
-    """Create MindRecord file."""
-    mindrecord_dir = args.mindrecord_dir
-    mindrecord_path = os.path.join(mindrecord_dir, prefix)
-    writer = FileWriter(mindrecord_path, file_num)
-
-    image_ids, image_files_dict, image_anno_dict = create_coco_label(args, is_training)
-
-    detr_json = {
-        "image_id": {"type": "int32"},
-        "image": {"type": "bytes"},
-        "annotation": {"type": "int32", "shape": [-1, 6]},
-    }
-    writer.add_schema(detr_json, "detr_json")
-
-    for image_id in image_ids:
-        image_name = image_files_dict[image_id]
+def load_manifest(mindrecord_dir, prefix):
+    """conversion manifest of a MindRecord dataset, None for datasets written without one"""
+    manifest_file = os.path.join(mindrecord_dir, prefix + ".manifest.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(mindrecord_dir, prefix, manifest):
+    manifest_file = os.path.join(mindrecord_dir, prefix + ".manifest.json")
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def mindrecord_files(mindrecord_dir, prefix):
+    """files to read with MindDataset: every shard of the manifest, or the first file of a single set"""
+    manifest = load_manifest(mindrecord_dir, prefix)
+    if manifest is None:
+        return os.path.join(mindrecord_dir, prefix + "0")
+    return [os.path.join(mindrecord_dir, shard['file']) for shard in manifest['shards']]
+
+
+def storage_scale(h, w, max_size):
+    """
+    Largest scale the augmentation (and eval) can resample an h x w image to: the long side is capped at
+    max_size, except for the resize before RandomSizeCrop, which only fixes the short side. Never above 1.
+    """
+    return min(1., max(max_size / max(h, w), max(CROP_RESIZE_SIZES) / min(h, w)))
+
+
+def resize_encoded_image(img, max_size):
+    """Re-encode a jpeg at its storage scale, return the bytes and the original (h, w)."""
+    image = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    h, w = image.shape[:2]
+    scale = storage_scale(h, w, max_size)
+    if scale < 1:
+        size = (int(np.ceil(w * scale)), int(np.ceil(h * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        img = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+    return img, np.array([h, w], dtype=np.int32)
+
+
+def write_mindrecord_shard(job):
+    """
+    Write the rows of one shard as a single-file MindRecord, rows_per_write rows per write call.
+    With max_size the images are stored at their storage scale, with their original size in "ori_size".
+    """
+    mindrecord_path, rows, rows_per_write, max_size = job
+    # leftovers of an interrupted conversion
+    for path in (mindrecord_path, mindrecord_path + ".db"):
+        if os.path.exists(path):
+            os.remove(path)
+    writer = FileWriter(mindrecord_path, 1)
+    schema = dict(DETR_SCHEMA)
+    if max_size:
+        schema["ori_size"] = {"type": "int32", "shape": [2]}
+    writer.add_schema(schema, "detr_json")
+
+    batch = []
+    for image_id, image_name, annos in rows:
         with open(image_name, 'rb') as f:
             img = f.read()
-        annos = np.array(image_anno_dict[image_name], dtype=np.int32)
-        row = {"image_id": image_id, "image": img, "annotation": annos}
-        writer.write_raw_data([row])
-
+        row = {"image_id": image_id, "image": img, "annotation": np.array(annos, dtype=np.int32)}
+        if max_size:
+            row["image"], row["ori_size"] = resize_encoded_image(img, max_size)
+        batch.append(row)
+        if len(batch) == rows_per_write:
+            writer.write_raw_data(batch)
+            batch = []
+    if batch:
+        writer.write_raw_data(batch)
     writer.commit()
+    return mindrecord_path
+
+
+def new_image_ids(manifest, image_ids):
+    """image ids that are in none of the shards of the manifest"""
+    known = set(img_id for shard in manifest["shards"] for img_id in shard["image_ids"])
+    return [img_id for img_id in image_ids if img_id not in known]
+
+
+def append_shards(manifest, prefix, image_ids):
+    """
+    Plan new shards, no larger than the existing ones, for the image ids that are not in the manifest yet
+    (a single shard if the manifest has none). Return the number of new images.
+    """
+    new_ids = np.array(new_image_ids(manifest, image_ids), dtype=np.int64)
+    if not new_ids.size:
+        return 0
+    shard_size = max([len(shard["image_ids"]) for shard in manifest["shards"]] or [new_ids.size])
+    first = len(manifest["shards"])
+    manifest["shards"] += [{"file": prefix + str(first + i), "image_ids": ids.tolist(), "done": False}
+                           for i, ids in enumerate(np.array_split(new_ids, int(np.ceil(new_ids.size / shard_size))))]
+    manifest["complete"] = False
+    return int(new_ids.size)
+
+
+def data_to_mindrecord_byte_image(args, prefix="DETR.mindrecord", is_training=True, file_num=8, labels=None):
+    """
+    Create MindRecord files, file_num single-file shards written by parallel worker processes.
+    The shard plan and the finished shards are recorded in a manifest, so an interrupted
+    conversion resumes from the unfinished shards. With args.mindrecord_append the images of
+    the annotations that are not in the manifest yet are converted into new shards.
+    labels is the output of create_coco_label, built here if not given.
+    """
+    mindrecord_dir = args.mindrecord_dir
+    image_ids, image_files_dict, image_anno_dict = labels or create_coco_label(args, is_training)
+
+    manifest = load_manifest(mindrecord_dir, prefix)
+    if manifest is not None and args.mindrecord_append:
+        num_shards = len(manifest["shards"])
+        num_new = append_shards(manifest, prefix, image_ids)
+        print(f'Append {num_new} new images in {len(manifest["shards"]) - num_shards} new shards')
+        save_manifest(mindrecord_dir, prefix, manifest)
+    elif manifest is None:
+        manifest = {
+            "complete": False,
+            # images stored at their storage scale, with an "ori_size" column
+            "max_size": args.max_size if args.resize_mindrecord else 0,
+            "shards": [{"file": prefix + str(i), "image_ids": ids.tolist(), "done": False}
+                       for i, ids in enumerate(np.array_split(np.array(image_ids, dtype=np.int64), file_num))],
+        }
+        save_manifest(mindrecord_dir, prefix, manifest)
+
+    jobs = []
+    for shard in manifest["shards"]:
+        if shard["done"]:
+            continue
+        rows = [(img_id, image_files_dict[img_id], image_anno_dict[image_files_dict[img_id]])
+                for img_id in shard["image_ids"]]
+        jobs.append((os.path.join(mindrecord_dir, shard["file"]), rows, MINDRECORD_ROWS_PER_WRITE,
+                     manifest.get("max_size", 0)))
+
+    if jobs:
+        # spawn: the training process may already hold device and communication resources
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(min(args.mindrecord_workers, len(jobs))) as pool:
+            for mindrecord_path in pool.imap_unordered(write_mindrecord_shard, jobs):
+                file_name = os.path.basename(mindrecord_path)
+                for shard in manifest["shards"]:
+                    if shard["file"] == file_name:
+                        shard["done"] = True
+                save_manifest(mindrecord_dir, prefix, manifest)
+                num_done = sum(shard["done"] for shard in manifest["shards"])
+                print(f'{file_name} done, {num_done}/{len(manifest["shards"])} shards', flush=True)
+
+    manifest["complete"] = True
+    save_manifest(mindrecord_dir, prefix, manifest)
+
+
+def dataset_manifest(mindrecord_file):
+    """manifest of the dataset mindrecord_file (as returned by create_mindrecord) belongs to"""
+    first_file = mindrecord_file[0] if isinstance(mindrecord_file, list) else mindrecord_file
+    prefix = os.path.basename(first_file).rstrip("0123456789")
+    return load_manifest(os.path.dirname(first_file), prefix)
+
+
+def mindrecord_complete(mindrecord_dir, prefix):
+    manifest = load_manifest(mindrecord_dir, prefix)
+    if manifest is None:
+        return os.path.exists(os.path.join(mindrecord_dir, prefix + "0"))
+    return manifest["complete"]
+
+
+def mindrecord_up_to_date(args, prefix, image_ids=None):
+    """complete, and with args.mindrecord_append holding every one of the annotated image_ids"""
+    if not mindrecord_complete(args.mindrecord_dir, prefix):
+        return False
+    manifest = load_manifest(args.mindrecord_dir, prefix)
+    if not args.mindrecord_append or manifest is None:
+        return True
+    return not new_image_ids(manifest, image_ids)
 
 
 def create_mindrecord(args, rank=0, prefix="DETR.mindrecord", is_training=True):
     print("Start create DETR dataset")
 
-    # It will generate mindrecord file in config.mindrecord_dir,
-    # and the file name is DETR.mindrecord0, 1, ... file_num.
+    # It will generate mindrecord files in config.mindrecord_dir,
+    # and the file names are DETR.mindrecord0, 1, ... file_num, listed in DETR.mindrecord.manifest.json.
     mindrecord_dir = args.mindrecord_dir
-    mindrecord_file = os.path.join(mindrecord_dir, prefix + "0")
     print("CHECKING MINDRECORD FILES ...")
 
-    if rank == 0 and not os.path.exists(mindrecord_file):
+    if args.mindrecord_append and mindrecord_complete(mindrecord_dir, prefix) \
+            and load_manifest(mindrecord_dir, prefix) is None:
+        print("Datasets converted without a manifest can not be appended to, reconvert them to use "
+              "--mindrecord_append.")
+    # the annotations are only needed to find the images to append
+    labels = create_coco_label(args, is_training) if args.mindrecord_append else None
+    image_ids = labels[0] if labels else None
+    if rank == 0 and not mindrecord_up_to_date(args, prefix, image_ids):
         if not os.path.isdir(mindrecord_dir):
             os.makedirs(mindrecord_dir)
         if args.dataset_file == "coco":
@@ -162,41 +335,98 @@ def create_mindrecord(args, rank=0, prefix="DETR.mindrecord", is_training=True):
                 if not os.path.exists(args.coco_path):
                     print("Please make sure config:coco_root is valid.")
                 print("Create Mindrecord. It may take some time.")
-                data_to_mindrecord_byte_image(args, prefix, is_training)
+                data_to_mindrecord_byte_image(args, prefix, is_training, args.mindrecord_shards, labels)
                 print("Create Mindrecord Done, at {}".format(mindrecord_dir))
             else:
                 print("coco_root not exits.")
+    elif rank != 0:
+        while not mindrecord_up_to_date(args, prefix, image_ids):
+            print("Waiting for rank 0 to create the MindRecord files ...", flush=True)
+            time.sleep(10)
     print("CHECKING MINDRECORD FILES DONE!")
-    return mindrecord_file
-
-
-def preprocess_fn(args, image_id, image, image_anno_dict, is_training):
-    """Preprocess function for dataset."""
+    return mindrecord_files(mindrecord_dir, prefix)
+
+
+def eval_size_fn(args):
+    """(h, w) -> size of the eval Resize"""
+    def size_fn(h, w):
+        return transform.get_size_with_aspect_ratio((h, w, 3), EVAL_SIZE, args.max_size)
+    return size_fn
+
+
+@traced('preprocess', 'data')
+def preprocess_fn(args, image_id, image, image_anno_dict, is_training, arena=None, ori_size=None, resized=False):
+    """
+    Preprocess function for dataset.
+    ori_size is the original (h, w) of images stored resized, the boxes are scaled to the stored image.
+    With args.reduced_decode image is still encoded, it is decoded at the smallest DCT scale that covers
+    the largest size the transforms below can request. With args.crop_aware_decode the training
+    augmentation is planned before decoding, see transform.CropAwareDecode.
+    resized eval images are already decoded and resized (eval cache), only normalized and padded.
+    """
+    crop_aware = is_training and args.crop_aware_decode
+    if args.reduced_decode and not (crop_aware or resized):
+        if is_training:
+            def size_fn(h, w):
+                scale = storage_scale(h, w, args.max_size)
+                return np.ceil(h * scale), np.ceil(w * scale)
+        else:
+            size_fn = eval_size_fn(args)
+        image, encoded_size = transform.decode_reduced(image, size_fn)
+        if ori_size is None:
+            ori_size = np.array(encoded_size)
+
+    # with reusable buffers the pixels are normalized while they are padded, in a single write
+    fused_normalize = arena is not None and not args.uint8_input
+    pad_kwargs = {'arena': arena}
+    if fused_normalize:
+        pad_kwargs.update(mean=IMAGE_MEAN, std=IMAGE_STD)
+    normalize = transform.Normalize(IMAGE_MEAN, IMAGE_STD,
+                                    normalize_image=not (args.uint8_input or fused_normalize))
     if is_training:
-        max_h_arr = [480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800]
-        trans = transform.Compose([
-            transform.RandomHorizontalFlip(),
-            transform.RandomSelect(
-                transform.RandomResize(max_h_arr, args.max_size),
-                transform.Compose([
-                    transform.RandomResize([400, 500, 600]),
-                    transform.RandomSizeCrop(384, 600),
-                    transform.RandomResize(max_h_arr, max_size=args.max_size),
-                ])
-            ),
-            transform.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ])
-        out_data = transform.OutData(is_training=True, max_size=args.max_size)
+        max_h_arr = TRAIN_SCALES
+        if crop_aware:
+            trans = transform.Compose([
+                transform.CropAwareDecode(max_h_arr, args.max_size, CROP_RESIZE_SIZES, 384, 600),
+                normalize,
+            ])
+        else:
+            trans = transform.Compose([
+                transform.RandomHorizontalFlip(),
+                transform.RandomSelect(
+                    transform.RandomResize(max_h_arr, args.max_size),
+                    transform.Compose([
+                        transform.RandomResize(CROP_RESIZE_SIZES),
+                        transform.RandomSizeCrop(384, 600),
+                        transform.RandomResize(max_h_arr, max_size=args.max_size),
+                    ])
+                ),
+                normalize,
+            ])
+        if args.shape_buckets:
+            pad_func = transform.BucketPad(parse_shape_buckets(args), **pad_kwargs)
+        elif args.aspect_grouping:
+            pad_func = transform.DynamicPad(args.max_size, args.pad_stride, **pad_kwargs)
+        else:
+            pad_func = transform.Pad(args.max_size, args.max_size, **pad_kwargs)
+        out_data = transform.OutData(is_training=True, max_size=args.max_size, pad_func=pad_func,
+                                     max_boxes=args.max_boxes, packed=args.packed_targets)
     else:
-        trans = transform.Compose([
-            transform.Resize(800, args.max_size),
-            transform.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        trans = transform.Compose([normalize] if resized else [
+            transform.Resize(EVAL_SIZE, args.max_size),
+            normalize,
         ])
-        out_data = transform.OutData(is_training=False, max_size=args.max_size)
+        pad_func = transform.Pad(args.max_size, args.max_size, **pad_kwargs)
+        out_data = transform.OutData(is_training=False, max_size=args.max_size, pad_func=pad_func)
 
-    image_shape = image.shape[:2]
+    image_shape = transform.encoded_size(image) if crop_aware else image.shape[:2]
     ori_shape = image_shape
     gt_box = image_anno_dict[:, :4]
+    if ori_size is not None:
+        ori_shape = tuple(ori_size.tolist())
+        if ori_shape != image_shape:
+            ratio_height, ratio_width = image_shape[0] / ori_shape[0], image_shape[1] / ori_shape[1]
+            gt_box = gt_box * np.array([ratio_width, ratio_height, ratio_width, ratio_height])
     gt_label = image_anno_dict[:, 4]
 
     target = {
@@ -210,28 +440,179 @@ def preprocess_fn(args, image_id, image, image_anno_dict, is_training):
     return out_data(image, target)
 
 
-def create_detr_dataset(args, mindrecord_file, batch_size=2, device_num=1,
-                        rank_id=0, is_training=True, num_parallel_workers=8, python_multiprocessing=False):
+def sample_bytes(args):
+    """upper bound of the bytes of one preprocessed training sample"""
+    # the padded image and mask share the dtype, boxes, labels and valid are small
+    itemsize = 1 if args.uint8_input else 4
+    return args.max_size * args.max_size * 4 * itemsize + args.max_boxes * (4 * 4 + 4 + 1)
+
+
+def max_rowsize(args):
+    """
+    Shared memory slot size in MB of the python_multiprocessing map.
+    Rows that do not fit a slot are pickled through a pipe instead, so the slots must hold a
+    whole max_size x max_size sample.
+    """
+    if args.max_rowsize:
+        return args.max_rowsize
+    return int(np.ceil(sample_bytes(args) / (1 << 20))) + 1
+
+
+def parse_shape_buckets(args):
+    """
+    Parse args.shape_buckets ("HxW,HxW,...") into (h, w) tuples sorted by area.
+    The (max_size, max_size) bucket is always added so that every sample fits.
+    """
+    buckets = set()
+    for item in args.shape_buckets.split(','):
+        if item.strip():
+            h, w = item.lower().split('x')
+            buckets.add((int(h), int(w)))
+    buckets.add((args.max_size, args.max_size))
+    return sorted(buckets, key=lambda hw: hw[0] * hw[1])
+
+
+def aspect_ratio_group(image):
+    """Aspect ratio group id of a (3, H, W) image."""
+    _, h, w = image.shape
+    return int(np.searchsorted(ASPECT_RATIO_BINS, w / h))
+
+
+def pack_targets(boxes, labels, valid):
+    """
+    Pack a batch of targets padded to its largest member into flat boxes (N, 4), labels (N,)
+    and the number of boxes of each image (bs,).
+    """
+    return boxes[valid], labels[valid], valid.sum(1).astype(np.int32)
+
+
+def group_batch(ds, batch_size, group_fn, num_groups, pad_info=None):
+    """
+    Batch images with the same group_fn id together and pad each batch only to its largest member.
+    The per sample padding keeps the image sizes in a bounded set, so the batch shapes stay bounded too.
+    The group ids depend on the random transforms, so the number of full batches varies between epochs:
+    every group drops less than batch_size samples. The epoch is cut to the number of batches it
+    always has, which makes the dataset size exact.
+    """
+    pad_info = {"image": (None, 0), "mask": (None, 1), **(pad_info or {})}
+    if num_groups == 1:
+        # bucket_batch_by_length needs at least one boundary
+        return ds.batch(batch_size, drop_remainder=True, pad_info=pad_info)
+    num_samples = ds.get_dataset_size()
+    num_batches = max(0, (num_samples - num_groups * (batch_size - 1)) // batch_size)
+    ds = ds.bucket_batch_by_length(["image"],
+                                   bucket_boundaries=list(range(1, num_groups)),
+                                   bucket_batch_sizes=[batch_size] * num_groups,
+                                   element_length_function=group_fn,
+                                   pad_info=pad_info,
+                                   drop_remainder=True)
+    ds = ds.take(num_batches)
+    # bucket batching can only count its batches by running the whole pipeline
+    ds.dataset_size = num_batches
+    return ds
+
+
+def map_keep_size(ds, **kwargs):
+    """
+    ds.map(**kwargs) keeping the dataset size set on ds (by group_batch): a new node does not
+    inherit it, and counting the batches of bucket batching runs the whole pipeline.
+    """
+    dataset_size = ds.dataset_size
+    ds = ds.map(**kwargs)
+    ds.dataset_size = dataset_size
+    return ds
+
+
+# CocoStream of each source and rank, the labels and sizes are built once for all the epochs
+_coco_streams = {}
+
+
+def create_coco_stream(args, is_training, device_num=1, rank_id=0, epoch=0):
+    """CocoStream of args.stream_source for this rank, at epoch (shuffled with seed + epoch)"""
+    key = (args.stream_source, is_training, device_num, rank_id)
+    if key not in _coco_streams:
+        data_type = args.train_data_type if is_training else args.val_data_type
+        _, image_files_dict, image_anno_dict = create_coco_label(args, is_training)
+        _coco_streams[key] = CocoStream(args.stream_source, os.path.join(args.coco_path, data_type),
+                                        image_files_dict, image_anno_dict, num_shards=device_num,
+                                        shard_id=rank_id, shuffle=is_training,
+                                        shuffle_buffer=args.stream_shuffle_buffer, seed=args.seed)
+    stream = _coco_streams[key]
+    stream.epoch = epoch
+    return stream
+
+
+def create_detr_dataset(args, mindrecord_file, batch_size=2, device_num=1, rank_id=0, is_training=True,
+                        num_parallel_workers=8, python_multiprocessing=False, stop_after=None,
+                        epoch=None, skip_samples=0):
+    """
+    Create the DETR dataset.
+    stop_after ('read', 'decode' or 'transform') returns the pipeline truncated after that stage,
+    for the data pipeline benchmark.
+    With args.stream_source the samples are streamed from the image folder or tar shards
+    and mindrecord_file is not used.
+    With epoch the sample order is the one of that epoch (seed + epoch), whatever the pipelines created
+    before, and the first skip_samples rows of this rank are dropped before they are decoded.
+    """
     cv2.setNumThreads(0)
-    de.config.set_prefetch_size(8)
-    ds = de.MindDataset(mindrecord_file, columns_list=["image_id", "image", "annotation"], num_shards=device_num,
-                        shard_id=rank_id, num_parallel_workers=num_parallel_workers, shuffle=is_training)
-    decode = C.Decode()
-    ds = ds.map(input_columns=["image"], operations=decode)
-    compose_map_func = (lambda image_id, image, annotation: preprocess_fn(args, image_id, image, annotation, is_training))
+    de.config.set_prefetch_size(args.prefetch_size)
+    if epoch is not None:
+        de.config.set_seed(args.seed + epoch)
+    columns = ["image_id", "image", "annotation"]
+    if args.stream_source:
+        # the stream splits the data between the ranks and shuffles itself
+        ds = de.GeneratorDataset(create_coco_stream(args, is_training, device_num, rank_id, epoch or 0),
+                                 column_names=columns, shuffle=False)
+    else:
+        manifest = dataset_manifest(mindrecord_file)
+        if manifest is not None and manifest.get("max_size", 0):
+            columns.append("ori_size")
+        ds = de.MindDataset(mindrecord_file, columns_list=columns, num_shards=device_num,
+                            shard_id=rank_id, num_parallel_workers=args.reader_workers or num_parallel_workers,
+                            shuffle=is_training)
+    if skip_samples:
+        ds = ds.skip(skip_samples)
+    if stop_after == 'read':
+        return ds
+    if not (args.reduced_decode or (is_training and args.crop_aware_decode)):
+        decode = C.Decode()
+        ds = ds.map(input_columns=["image"], operations=decode)
+    if stop_after == 'decode':
+        return ds
+    arena = transform.BufferArena() if args.reuse_buffers else None
+    compose_map_func = (lambda image_id, image, annotation, *ori_size: preprocess_fn(args, image_id, image, annotation,
+                                                                                     is_training, arena, *ori_size))
 
     if is_training:
-        ds = ds.map(input_columns=["image_id", "image", "annotation"],
+        ds = ds.map(input_columns=columns,
                     output_columns=["image", "mask", "boxes", "labels", "valid"],
                     column_order=["image", "mask", "boxes", "labels", "valid"],
                     operations=compose_map_func, python_multiprocessing=python_multiprocessing,
-                    num_parallel_workers=num_parallel_workers)
-        ds = ds.batch(batch_size, drop_remainder=True)
+                    num_parallel_workers=num_parallel_workers, max_rowsize=max_rowsize(args))
+        if stop_after == 'transform':
+            return ds
+        # variable-length targets are padded to the largest of the batch, then packed
+        pad_info = TARGET_PAD_INFO if args.packed_targets else None
+        if args.shape_buckets:
+            buckets = parse_shape_buckets(args)
+            bucket_ids = {hw: i for i, hw in enumerate(buckets)}
+            ds = group_batch(ds, batch_size, lambda image: bucket_ids[image.shape[1:]], len(buckets), pad_info)
+        elif args.aspect_grouping:
+            ds = group_batch(ds, batch_size, aspect_ratio_group, len(ASPECT_RATIO_BINS) + 1, pad_info)
+        else:
+            ds = ds.batch(batch_size, drop_remainder=True, pad_info=pad_info)
+        if args.packed_targets:
+            ds = map_keep_size(ds, input_columns=["boxes", "labels", "valid"],
+                               output_columns=["boxes", "labels", "num_boxes"],
+                               column_order=["image", "mask", "boxes", "labels", "num_boxes"],
+                               operations=pack_targets)
     else:
-        ds = ds.map(input_columns=["image_id", "image", "annotation"],
+        ds = ds.map(input_columns=columns,
                     output_columns=["image", "mask", "image_id", "ori_size"],
                     column_order=["image", "mask", "image_id", "ori_size"],
                     operations=compose_map_func,
                     num_parallel_workers=num_parallel_workers)
+        if stop_after == 'transform':
+            return ds
         ds = ds.batch(batch_size, drop_remainder=False)
     return ds
@@ -0,0 +1,131 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Resized eval images in a memory-mapped file, built once per (max_size, dataset)."""
+
+import os
+import time
+import hashlib
+import numpy as np
+import mindspore.dataset as de
+
+from src.data import transform
+from src.data.dataset import EVAL_SIZE, create_detr_dataset, eval_size_fn, preprocess_fn
+
+CACHE_VERSION = 1
+EMPTY_ANNOTATION = np.zeros((0, 6), np.int32)
+
+
+def cache_key(args, mindrecord_file):
+    """key of the cached eval images: the resize and decode settings and the mindrecord files"""
+    files = mindrecord_file if isinstance(mindrecord_file, list) else [mindrecord_file]
+    sha1 = hashlib.sha1(f'v{CACHE_VERSION} {EVAL_SIZE} {args.max_size} {args.reduced_decode}'.encode())
+    for path in files:
+        stat = os.stat(path)
+        sha1.update(f' {os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}'.encode())
+    return sha1.hexdigest()[:16]
+
+
+def resize_eval_image(args, image, ori_size=None):
+    """eval decode and Resize of preprocess_fn, return the uint8 HWC image and the original (h, w)"""
+    if args.reduced_decode:
+        image, encoded_size = transform.decode_reduced(image, eval_size_fn(args))
+    else:
+        encoded_size = image.shape[:2]
+    if ori_size is None:
+        ori_size = encoded_size
+    image, _ = transform.Resize(EVAL_SIZE, args.max_size)(image, {'boxes': np.zeros((0, 4))})
+    return np.ascontiguousarray(image, dtype=np.uint8), np.array(ori_size, dtype=np.int32)
+
+
+class EvalCache(object):
+    """
+    Random access source of the cached eval images: image i is bytes offsets[i]:offsets[i + 1]
+    of the flat uint8 file, with shape (*sizes[i], 3).
+    """
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        with np.load(index_path, allow_pickle=False) as index:
+            self.image_ids = index['image_ids']
+            self.ori_sizes = index['ori_sizes']
+            self.sizes = index['sizes']
+            self.offsets = index['offsets']
+        self.data = None
+
+    def __getstate__(self):
+        # worker processes map the file themselves instead of receiving a copy of it
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, i):
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        h, w = self.sizes[i]
+        image = self.data[self.offsets[i]:self.offsets[i + 1]].reshape(h, w, 3)
+        return np.array(self.image_ids[i]), image, self.ori_sizes[i]
+
+
+def build_eval_cache(args, mindrecord_file, data_path, index_path):
+    """decode and resize the eval mindrecord once, write the images and their index"""
+    print(f'Build eval cache {data_path}. It may take some time.')
+    start_time = time.time()
+    ds = create_detr_dataset(args, mindrecord_file, is_training=False,
+                             num_parallel_workers=args.num_parallel_workers, stop_after='decode')
+    ds = ds.map(input_columns=ds.get_col_names(),
+                output_columns=["image_id", "image", "ori_size"],
+                column_order=["image_id", "image", "ori_size"],
+                operations=lambda image_id, image, annotation, *ori_size: (
+                    image_id, *resize_eval_image(args, image, *ori_size)),
+                num_parallel_workers=args.num_parallel_workers)
+
+    image_ids, ori_sizes, sizes, offsets = [], [], [], [0]
+    with open(data_path + '.tmp', 'wb') as f:
+        for image_id, image, ori_size in ds.create_tuple_iterator(output_numpy=True, num_epochs=1):
+            f.write(image.tobytes())
+            image_ids.append(image_id)
+            ori_sizes.append(ori_size)
+            sizes.append(image.shape[:2])
+            offsets.append(offsets[-1] + image.nbytes)
+    os.replace(data_path + '.tmp', data_path)
+    # the index is written last, its presence marks a complete cache
+    with open(index_path + '.tmp', 'wb') as f:
+        np.savez(f, image_ids=np.array(image_ids, np.int32).reshape(-1), ori_sizes=np.array(ori_sizes, np.int32),
+                 sizes=np.array(sizes, np.int64), offsets=np.array(offsets, np.int64))
+    os.replace(index_path + '.tmp', index_path)
+    print(f'Eval cache of {len(image_ids)} images, {offsets[-1] / (1 << 30):.2f} GB, '
+          f'built in {time.time() - start_time:.1f}s')
+
+
+def create_eval_cache_dataset(args, mindrecord_file, cache_dir, batch_size=2, num_parallel_workers=8):
+    """eval dataset reading the resized images from the cache in cache_dir, built first if needed"""
+    os.makedirs(cache_dir, exist_ok=True)
+    name = f'DETR.eval.{cache_key(args, mindrecord_file)}'
+    data_path = os.path.join(cache_dir, name + '.u8')
+    index_path = os.path.join(cache_dir, name + '.npz')
+    if not os.path.exists(index_path):
+        build_eval_cache(args, mindrecord_file, data_path, index_path)
+
+    ds = de.GeneratorDataset(EvalCache(data_path, index_path), column_names=["image_id", "image", "ori_size"],
+                             shuffle=False, num_parallel_workers=num_parallel_workers)
+    arena = transform.BufferArena() if args.reuse_buffers else None
+    ds = ds.map(input_columns=["image_id", "image", "ori_size"],
+                output_columns=["image", "mask", "image_id", "ori_size"],
+                column_order=["image", "mask", "image_id", "ori_size"],
+                operations=lambda image_id, image, ori_size: preprocess_fn(
+                    args, image_id, image, EMPTY_ANNOTATION, False, arena, ori_size, resized=True),
+                num_parallel_workers=num_parallel_workers)
+    return ds.batch(batch_size, drop_remainder=False)
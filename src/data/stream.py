@@ -0,0 +1,127 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Stream COCO samples straight from the image folder or from tar shards, without MindRecord conversion."""
+
+import os
+import glob
+import tarfile
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# consecutive folder images read as one unit
+FOLDER_CHUNK_SIZE = 1000
+TAR_BUFFER_SIZE = 1 << 24
+
+
+class CocoStream(object):
+    """
+    Iterable source of (image_id, image, annotation) rows, the columns of the MindRecord datasets.
+
+    The images come from the COCO image folder (source 'folder') or from WebDataset style tar shards
+    (source is a glob of .tar files) whose members are <key>.jpg, key being the file name stem in the
+    annotations. Members without annotations are skipped. Reads are sequential: the folder is read in
+    chunks of consecutive file names and each shard in a single pass. The chunks (or shards) are split
+    between the ranks, shuffled with seed + epoch, and the samples go through a shuffle buffer.
+    Every rank yields as many samples as the smallest rank has, so that the ranks run the same
+    number of steps.
+    """
+    def __init__(self, source, image_dir, image_files, image_annos, num_shards=1, shard_id=0,
+                 shuffle=True, shuffle_buffer=1000, seed=0):
+        # file name stem -> (image id, annotation)
+        self.rows = {}
+        for img_id, path in image_files.items():
+            self.rows[os.path.splitext(os.path.basename(path))[0]] = (img_id, image_annos[path])
+
+        if source == 'folder':
+            self.tar_files = None
+            names = sorted(os.path.basename(image_files[img_id]) for img_id in image_files)
+            units = [[os.path.join(image_dir, name) for name in names[i:i + FOLDER_CHUNK_SIZE]]
+                     for i in range(0, len(names), FOLDER_CHUNK_SIZE)]
+        else:
+            self.tar_files = sorted(glob.glob(source))
+            if not self.tar_files:
+                raise ValueError(f'no tar shards match {source}')
+            units = self.tar_files
+        if len(units) < num_shards:
+            raise ValueError(f'{len(units)} chunks or shards can not be split between {num_shards} ranks')
+        self.all_units = units
+        self.num_shards = num_shards
+        self.units = units[shard_id::num_shards]
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = None
+
+    def __len__(self):
+        if self.num_samples is None:
+            if self.tar_files is None:
+                sizes = [len(unit) for unit in self.all_units]
+            else:
+                sizes = [sum(1 for _ in self.tar_keys(path)) for path in self.all_units]
+            self.num_samples = min(sum(sizes[i::self.num_shards]) for i in range(self.num_shards))
+        return self.num_samples
+
+    def tar_keys(self, path):
+        """keys of the annotated images of a tar shard, from its headers"""
+        with tarfile.open(path, 'r') as tar:
+            for name in tar.getnames():
+                key, ext = os.path.splitext(os.path.basename(name))
+                if ext.lower() in IMAGE_EXTENSIONS and key in self.rows:
+                    yield key
+
+    def read_unit(self, unit):
+        """(key, encoded image) of the annotated images of a folder chunk or tar shard, in storage order"""
+        if self.tar_files is None:
+            for path in unit:
+                with open(path, 'rb') as f:
+                    yield os.path.splitext(os.path.basename(path))[0], f.read()
+            return
+        with tarfile.open(unit, 'r|', bufsize=TAR_BUFFER_SIZE) as tar:
+            for member in tar:
+                key, ext = os.path.splitext(os.path.basename(member.name))
+                if member.isfile() and ext.lower() in IMAGE_EXTENSIONS and key in self.rows:
+                    yield key, tar.extractfile(member).read()
+
+    def __iter__(self):
+        num_samples = len(self)
+        for i, sample in enumerate(self.samples()):
+            if i == num_samples:
+                break
+            yield sample
+
+    def samples(self):
+        """every sample of the units of this rank, shuffled"""
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        units = list(self.units)
+        if self.shuffle:
+            units = [units[i] for i in rng.permutation(len(units))]
+
+        buffer = []
+        for unit in units:
+            for key, data in self.read_unit(unit):
+                img_id, annos = self.rows[key]
+                sample = (np.array(img_id, np.int32), np.frombuffer(data, np.uint8),
+                          np.array(annos, np.int32).reshape(-1, 6))
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if buffer:
+                    i = rng.randint(len(buffer))
+                    buffer[i], sample = sample, buffer[i]
+                yield sample
+        if self.shuffle:
+            rng.shuffle(buffer)
+        yield from buffer
@@ -13,17 +13,17 @@
 # limitations under the License.
 # ============================================================================
 
+import io
 import random
+import threading
 import cv2
 import numpy as np
+from PIL import Image
 
 
 def box_xyxy_to_cxcywh(x):
     """box xyxy to cxcywh"""
-    x0, y0, x1, y1 = np.array_split(x.T, 4)
-    b = [(x0 + x1) / 2, (y0 + y1) / 2,
-         (x1 - x0), (y1 - y0)]
-    return np.stack(b, axis=-1)[0]
+    return np.concatenate([(x[:, :2] + x[:, 2:]) / 2, x[:, 2:] - x[:, :2]], axis=1)
 
 
 def box_cxcywh_to_xyxy(x):
@@ -34,6 +34,25 @@ def box_cxcywh_to_xyxy(x):
     return np.stack(b, axis=-1).squeeze(-2)
 
 
+def encoded_size(data):
+    """(h, w) of an encoded image, from its header"""
+    w, h = Image.open(io.BytesIO(data)).size
+    return h, w
+
+
+def decode_reduced(data, size_fn):
+    """
+    Decode an encoded image with libjpeg DCT scaling (1/2, 1/4 or 1/8) at the smallest scale
+    whose size still covers size_fn(h, w), the size the following transforms will resize to.
+    Returns the RGB image and the (h, w) of the encoded image.
+    """
+    img = Image.open(io.BytesIO(data))
+    w, h = img.size
+    req_h, req_w = size_fn(h, w)
+    img.draft('RGB', (max(int(req_w), 1), max(int(req_h), 1)))
+    return np.asarray(img.convert('RGB')), (h, w)
+
+
 class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
@@ -60,6 +79,70 @@ class RandomSelect(object):
         return self.transforms2(image, target)
 
 
+# The geometric transforms do not touch the boxes: they compose a pending affine map
+# x -> sx * x + tx, y -> sy * y + ty (sx < 0 for flips) in target['box_affine'] instead.
+# apply_box_affine maps the boxes once at the end, clipped to the image and filtered if it was cropped.
+IDENTITY_AFFINE = (1., 0., 1., 0.)
+
+
+def hflip_target(target, w):
+    """target of a horizontally flipped image of width w"""
+    sx, tx, sy, ty = target.get('box_affine', IDENTITY_AFFINE)
+    return dict(target, box_affine=(-sx, w - tx, sy, ty))
+
+
+def resize_target(target, size, new_size):
+    """target of an image resized from size (h, w) to new_size (nh, nw)"""
+    h, w = size
+    nh, nw = new_size
+    ratio_width, ratio_height = float(nw)/float(w), float(nh)/float(h)
+    sx, tx, sy, ty = target.get('box_affine', IDENTITY_AFFINE)
+    return dict(target, box_affine=(sx * ratio_width, tx * ratio_width, sy * ratio_height, ty * ratio_height),
+                size=(nh, nw))
+
+
+def map_boxes(boxes, box_affine):
+    """xyxy boxes through the affine map"""
+    sx, tx, sy, ty = box_affine
+    boxes = boxes * np.array([sx, sy, sx, sy]) + np.array([tx, ty, tx, ty])
+    if sx < 0:
+        boxes = boxes[:, [2, 1, 0, 3]]
+    return boxes
+
+
+def clip_boxes(boxes, h, w):
+    """boxes clipped to an h x w image, and the mask of the non-empty ones"""
+    boxes = np.minimum(boxes, np.array([w, h, w, h])).clip(0)
+    keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    return boxes, keep
+
+
+def crop_target(ori_target, region):
+    """target of the crop region (i, j, h, w) of an image, None if no box is left"""
+    i, j, h, w = region
+    sx, tx, sy, ty = ori_target.get('box_affine', IDENTITY_AFFINE)
+    box_affine = (sx, tx - j, sy, ty - i)
+    _, keep = clip_boxes(map_boxes(ori_target['boxes'], box_affine), h, w)
+    if not keep.any():
+        return None
+    return dict(ori_target, box_affine=box_affine, size=np.array([h, w]), cropped=True)
+
+
+def apply_box_affine(target):
+    """target with the pending affine applied to its boxes, clipped and filtered if the image was cropped"""
+    target = target.copy()
+    if 'box_affine' not in target:
+        return target
+    boxes = map_boxes(target['boxes'], target.pop('box_affine'))
+    if target.pop('cropped', False):
+        h, w = target['size']
+        boxes, keep = clip_boxes(boxes, h, w)
+        boxes = boxes[keep]
+        target['labels'] = target['labels'][keep]
+    target['boxes'] = boxes
+    return target
+
+
 class RandomHorizontalFlip(object):
     def __init__(self, p=0.5):
         self.p = p
@@ -68,11 +151,7 @@ class RandomHorizontalFlip(object):
         if random.random() < self.p:
             img = np.flip(img, 1)
             _, w, _ = img.shape
-
-            target = target.copy()
-            boxes = target["boxes"]
-            boxes = boxes[:, [2, 1, 0, 3]] * np.array([-1, 1, -1, 1]) + np.array([w, 0, w, 0])
-            target["boxes"] = boxes
+            target = hflip_target(target, w)
         return img, target
 
 
@@ -108,17 +187,7 @@ class Resize(object):
 
         nh, nw = get_size_with_aspect_ratio(img.shape, self.size, self.max_size)
         resize_pad_img = cv2.resize(img, (nw, nh), cv2.INTER_CUBIC)
-
-        target = target.copy()
-        # modify boxes
-        ratio_width, ratio_height = float(nw)/float(w), float(nh)/float(h)
-        boxes = target['boxes']
-        boxes = boxes * np.array([ratio_width, ratio_height, ratio_width, ratio_height])
-        target['boxes'] = boxes
-
-        # modify size
-        target['size'] = (nh, nw)
-
+        target = resize_target(target, (h, w), (nh, nw))
         return resize_pad_img, target
 
 
@@ -133,22 +202,108 @@ class RandomResize(object):
         return Resize(max_size=self.max_size, size=size)(img, target)
 
 
+class BufferArena(object):
+    """
+    Reusable output buffers, one set per worker thread (or process), keyed by shape, dtype and fill value.
+    The dataset pipeline copies every row a python operation returns before that worker produces the next one,
+    so a worker can overwrite its buffer for the next sample. Only the region written by the previous sample
+    and not covered by the new one is reset to the fill value, instead of allocating and filling a fresh canvas.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._local = threading.local()
+
+    def canvas(self, shape, dtype, fill, h, w):
+        """a buffer holding fill everywhere except [..., :h, :w], which the caller is about to overwrite"""
+        canvases = self._local.__dict__.setdefault('canvases', {})
+        key = (tuple(shape), np.dtype(dtype).str, fill)
+        if key not in canvases:
+            canvases[key] = [np.full(shape, fill, dtype=dtype), 0, 0]
+        entry = canvases[key]
+        buf, dirty_h, dirty_w = entry
+        if dirty_h > h:
+            buf[..., h:dirty_h, :dirty_w] = fill
+        if dirty_w > w:
+            buf[..., :min(h, dirty_h), w:dirty_w] = fill
+        entry[1], entry[2] = h, w
+        return buf
+
+
 class Pad(object):
-    def __init__(self, tgt_h, tgt_w):
+    """
+    Pad the HWC image into a CHW canvas and build the padding mask (1 on padded pixels).
+    With an arena the canvases are reused per worker, with mean and std the pixels
+    are normalized while they are written (use Normalize(normalize_image=False) before).
+    """
+    def __init__(self, tgt_h, tgt_w, arena=None, mean=None, std=None):
         self.tgt_h = tgt_h
         self.tgt_w = tgt_w
+        self.arena = arena
+        self.scale = None
+        self.shift = None
+        if mean is not None:
+            self.scale = (1 / (255 * np.array(std, np.float32))).reshape(-1, 1, 1)
+            self.shift = (-np.array(mean, np.float32) / np.array(std, np.float32)).reshape(-1, 1, 1)
+
+    def pad_size(self, h, w):
+        return self.tgt_h, self.tgt_w
 
     def __call__(self, img, target):
         h, w, c = img.shape
-        new_img = np.zeros((self.tgt_h, self.tgt_w, c), dtype=np.float32)
-        new_img[:h, :w, :] = img
-        new_mask = np.ones((self.tgt_h, self.tgt_w), dtype=np.float32)
+        tgt_h, tgt_w = self.pad_size(h, w)
+        # uint8 images stay uint8 (normalized on device), anything else is padded as float32
+        dtype = np.uint8 if img.dtype == np.uint8 and self.scale is None else np.float32
+        if self.arena is not None:
+            new_img = self.arena.canvas((c, tgt_h, tgt_w), dtype, 0, h, w)
+            new_mask = self.arena.canvas((tgt_h, tgt_w), dtype, 1, h, w)
+        else:
+            new_img = np.zeros((c, tgt_h, tgt_w), dtype=dtype)
+            new_mask = np.ones((tgt_h, tgt_w), dtype=dtype)
+        if self.scale is not None:
+            region = new_img[:, :h, :w]
+            np.multiply(img.transpose(2, 0, 1), self.scale, out=region, casting='unsafe')
+            region += self.shift
+        else:
+            new_img[:, :h, :w] = img.transpose(2, 0, 1)
         new_mask[:h, :w] = 0
         target['mask'] = new_mask
-        target['size'] = (self.tgt_h, self.tgt_w)
+        target['size'] = (tgt_h, tgt_w)
         return new_img, target
 
 
+class DynamicPad(Pad):
+    """
+    Pad to the image size rounded up to a multiple of stride (capped at max_size),
+    so that the padded shapes come from a small bounded set.
+    """
+    def __init__(self, max_size, stride=128, **kwargs):
+        super(DynamicPad, self).__init__(max_size, max_size, **kwargs)
+        self.stride = stride
+
+    def pad_size(self, h, w):
+        tgt_h = min(-(-h // self.stride) * self.stride, max(self.tgt_h, h))
+        tgt_w = min(-(-w // self.stride) * self.stride, max(self.tgt_w, w))
+        return tgt_h, tgt_w
+
+
+class BucketPad(Pad):
+    """Pad to the smallest (by area) of a fixed set of (h, w) buckets that holds the image."""
+    def __init__(self, buckets, **kwargs):
+        self.buckets = sorted(buckets, key=lambda hw: hw[0] * hw[1])
+        super(BucketPad, self).__init__(*self.buckets[-1], **kwargs)
+
+    def pad_size(self, h, w):
+        for tgt_h, tgt_w in self.buckets:
+            if h <= tgt_h and w <= tgt_w:
+                return tgt_h, tgt_w
+        raise ValueError(f'image of size {(h, w)} does not fit in any shape bucket {self.buckets}')
+
+
 class RandomSizeCrop(object):
     """random size crop"""
     def __init__(self, min_size: int, max_size: int):
@@ -164,36 +319,101 @@ class RandomSizeCrop(object):
         j = np.random.randint(0, img_w - w + 1)
 
         cropped_image = img[i: i + h, j: j + w]
-
-        target = ori_target.copy()
-        target["size"] = np.array([h, w])
-        bboxes = target['boxes']
-        max_size = np.array([w, h])
-        cropped_boxes = bboxes - np.array([j, i, j, i])
-        cropped_boxes = np.minimum(cropped_boxes.reshape(-1, 2, 2), max_size)
-        cropped_boxes = cropped_boxes.clip(0)
-        target['boxes'] = cropped_boxes.reshape(-1, 4)
-        keep = np.all(cropped_boxes[:, 1, :] > cropped_boxes[:, 0, :], axis=1)
-
-        target['boxes'] = target['boxes'][keep]
-        target['labels'] = target['labels'][keep]
-        if len(target['labels']) == 0:
+        target = crop_target(ori_target, (i, j, h, w))
+        if target is None:
             return img, ori_target
 
         return cropped_image, target
 
 
+class CropAwareDecode(object):
+    """
+    Decode an encoded image and apply the training augmentation
+        RandomHorizontalFlip(flip_p)
+        RandomSelect(RandomResize(scales, max_size),
+                     [RandomResize(crop_resize_sizes), RandomSizeCrop(crop_min, crop_max),
+                      RandomResize(scales, max_size)], select_p)
+    planned on the encoded image size before decoding. The random choices are drawn in the same order
+    and the boxes go through the same computations as the unplanned chain. The pixels only go through
+    one resampling: the source window of the output is mapped back to the encoded image, decoded at the
+    smallest DCT scale that still covers the output size, and warped (with the flip) to the output size.
+    """
+    def __init__(self, scales, max_size, crop_resize_sizes, crop_min, crop_max, flip_p=0.5, select_p=0.5):
+        self.scales = scales
+        self.max_size = max_size
+        self.crop_resize_sizes = crop_resize_sizes
+        self.crop_min = crop_min
+        self.crop_max = crop_max
+        self.flip_p = flip_p
+        self.select_p = select_p
+
+    def plan(self, h, w, target):
+        """output (h, w), source window (x0, y0, x1, y1) in flipped image coordinates, flip and target"""
+        flip = random.random() < self.flip_p
+        if flip:
+            target = hflip_target(target, w)
+        if random.random() < self.select_p:
+            out_size = get_size_with_aspect_ratio((h, w, 3), random.choice(self.scales), self.max_size)
+            return out_size, (0., 0., float(w), float(h)), flip, resize_target(target, (h, w), out_size)
+
+        # RandomResize(crop_resize_sizes) + RandomSizeCrop, in the coordinates of the resized image
+        rh, rw = get_size_with_aspect_ratio((h, w, 3), random.choice(self.crop_resize_sizes))
+        resized_target = resize_target(target, (h, w), (rh, rw))
+        cw = random.randint(self.crop_min, min(rw, self.crop_max))
+        ch = random.randint(self.crop_min, min(rh, self.crop_max))
+        i = np.random.randint(0, rh - ch + 1)
+        j = np.random.randint(0, rw - cw + 1)
+        cropped_target = crop_target(resized_target, (i, j, ch, cw))
+        if cropped_target is None:
+            i, j, ch, cw = 0, 0, rh, rw
+            cropped_target = resized_target
+
+        out_size = get_size_with_aspect_ratio((ch, cw, 3), random.choice(self.scales), self.max_size)
+        sx, sy = w / rw, h / rh
+        window = (j * sx, i * sy, (j + cw) * sx, (i + ch) * sy)
+        return out_size, window, flip, resize_target(cropped_target, (ch, cw), out_size)
+
+    def __call__(self, data, target):
+        img = Image.open(io.BytesIO(data))
+        w, h = img.size
+        (out_h, out_w), (x0, y0, x1, y1), flip, target = self.plan(h, w, target)
+        if flip:
+            x0, x1 = w - x1, w - x0
+
+        # decode at the smallest DCT scale that keeps the window at least as large as the output
+        img.draft('RGB', (max(int(np.ceil(w * out_w / (x1 - x0))), 1), max(int(np.ceil(h * out_h / (y1 - y0))), 1)))
+        image = np.asarray(img.convert('RGB'))
+        dh, dw, _ = image.shape
+        sx, sy = dw / w, dh / h
+
+        # inverse map from output pixel centers to decoded pixel coordinates, mirrored when flipped
+        ax, ay = (x1 - x0) * sx / out_w, (y1 - y0) * sy / out_h
+        if flip:
+            mat = np.array([[-ax, 0, x1 * sx - 0.5 * ax - 0.5], [0, ay, y0 * sy + 0.5 * ay - 0.5]])
+        else:
+            mat = np.array([[ax, 0, x0 * sx + 0.5 * ax - 0.5], [0, ay, y0 * sy + 0.5 * ay - 0.5]])
+        image = cv2.warpAffine(image, mat, (out_w, out_h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                               borderMode=cv2.BORDER_REPLICATE)
+        return image, target
+
+
 class Normalize(object):
-    def __init__(self, mean, std):
+    """
+    Normalize the boxes to cxcywh relative to the image size, and the pixels with mean and std.
+    With normalize_image=False the pixels are left untouched (uint8 pipeline, normalized on device).
+    """
+    def __init__(self, mean, std, normalize_image=True):
         self.mean = np.array(mean)
         self.std = np.array(std)
+        self.normalize_image = normalize_image
 
     def __call__(self, image, target):
-        image = (image / 255)
-        image = (image - self.mean) / self.std
+        if self.normalize_image:
+            image = (image / 255)
+            image = (image - self.mean) / self.std
         h, w, _ = image.shape
 
-        target = target.copy()
+        target = apply_box_affine(target)
         boxes = target["boxes"]
         boxes = box_xyxy_to_cxcywh(boxes)
         boxes = boxes / np.array([w, h, w, h], dtype=np.float32)
@@ -202,20 +422,34 @@ class Normalize(object):
 
 
 class OutData(object):
-    def __init__(self, is_training=True, max_size=1333):
+    """
+    Pad the image and output the network inputs. Training targets keep at most max_boxes boxes
+    (with a warning), padded to max_boxes, or left variable-length with packed=True for the batch
+    to pad them to its largest member.
+    """
+    def __init__(self, is_training=True, max_size=1333, pad_func=None, max_boxes=100, packed=False):
         self.is_training = is_training
-        self.pad_max_number = 100
-        self.pad_func = Pad(max_size, max_size)
+        self.pad_max_number = max_boxes
+        self.packed = packed
+        self.pad_func = pad_func if pad_func is not None else Pad(max_size, max_size)
 
     def __call__(self, img, target):
-        img, target = self.pad_func(img, target)
-        img_data = img.transpose(2, 0, 1).astype(np.float32)
+        img_data, target = self.pad_func(img, target)
         mask = target['mask']
         if self.is_training:
             boxes = target['boxes'].astype(np.float32)
             labels = target['labels'].astype(np.int32)
 
             box_num = len(labels)
+            if box_num > self.pad_max_number:
+                print(f'image {int(target["image_id"])} has {box_num} boxes, '
+                      f'only the first {self.pad_max_number} are kept (max_boxes)')
+                box_num = self.pad_max_number
+                boxes = boxes[:box_num]
+                labels = labels[:box_num]
+            if self.packed:
+                return img_data, mask, boxes, labels, np.ones((box_num,), np.bool_)
+
             gt_box = np.pad(boxes, ((0, self.pad_max_number - box_num), (0, 0)), mode="constant", constant_values=0)
             gt_label = np.pad(labels, (0, self.pad_max_number - box_num), mode="constant", constant_values=-1)
             gt_valid = np.zeros((self.pad_max_number,))
@@ -0,0 +1,88 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Callbacks of the data sink training (Model.train), one call per sink_size steps."""
+
+import os
+import time
+from mindspore.train.callback import Callback
+
+
+class SinkMonitor(Callback):
+    """
+    Log the training loop line after every sink (sink_size steps). The loss is the one of the
+    last step of the sink, the fps the mean over the sink.
+    With net_with_grad (a loss scaling train cell) the loss scale and the overflow count are logged too.
+    """
+    def __init__(self, batch_size, sink_size, dataset_size, start_epoch, epochs, lr, lr_backbone,
+                 accumulation_steps=1, net_with_grad=None):
+        super(SinkMonitor, self).__init__()
+        self.batch_size = batch_size
+        self.sink_size = sink_size
+        self.dataset_size = dataset_size
+        self.start_epoch = start_epoch
+        self.epochs = epochs
+        self.lr = lr
+        self.lr_backbone = lr_backbone
+        # lr steps are optimizer updates
+        self.accumulation_steps = accumulation_steps
+        self.net_with_grad = net_with_grad
+        self.start_time = None
+
+    def epoch_begin(self, run_context):
+        self.start_time = time.time()
+
+    def epoch_end(self, run_context):
+        cb_params = run_context.original_args()
+        cost = time.time() - self.start_time
+        loss = cb_params.net_outputs
+        # last step of the sink, counted from the start of the training
+        step = self.start_epoch * self.dataset_size + cb_params.cur_step_num - 1
+        e, i = divmod(step, self.dataset_size)
+        print('epoch[{}/{}], iter[{}/{}], loss:{:.4f}, fps:{:.2f} imgs/sec, lr:[{}/{}]'.format(
+            e, self.epochs,
+            i, self.dataset_size,
+            float(loss.asnumpy()),
+            self.batch_size * self.sink_size / cost,
+            self.lr_backbone[step // self.accumulation_steps], self.lr[step // self.accumulation_steps]
+        ), flush=True)
+        if self.net_with_grad is not None:
+            print('loss scale:{}, overflow steps:{}'.format(
+                float(self.net_with_grad.scale_sense.asnumpy()), int(self.net_with_grad.overflow_steps.asnumpy())
+            ), flush=True)
+
+
+class EpochCheckpoint(Callback):
+    """
+    Save net (the training cell, for the full training state) with ckpt_writer, an AsyncCheckpointWriter,
+    after every dataset epoch.
+    """
+    def __init__(self, net, ckpt_writer, sink_size, dataset_size, start_epoch, output_dir='./outputs'):
+        super(EpochCheckpoint, self).__init__()
+        self.net = net
+        self.ckpt_writer = ckpt_writer
+        self.sink_size = sink_size
+        self.dataset_size = dataset_size
+        self.start_epoch = start_epoch
+        self.output_dir = output_dir
+
+    def epoch_end(self, run_context):
+        cb_params = run_context.original_args()
+        step = cb_params.cur_step_num
+        # a sink can end past the end of a dataset epoch when sink_size does not divide it
+        if step // self.dataset_size == (step - self.sink_size) // self.dataset_size:
+            return
+        e = self.start_epoch + step // self.dataset_size - 1
+        ckpt_path = os.path.join(self.output_dir, f'detr_epoch_{e}.ckpt')
+        # the next dataset epoch starts at step 0
+        self.ckpt_writer.save(self.net, ckpt_path, append_dict={'epoch': e + 1, 'step': 0})
@@ -24,6 +24,8 @@ from mindspore import ms_function
 from mindspore.communication.management import get_group_size
 from mindspore.parallel._auto_parallel_context import auto_parallel_context
 
+from src.tools.timer import current_timer
+
 
 class WithLossCell(nn.Cell):
     def __init__(self, net, criterion):
@@ -66,13 +68,45 @@ def tensor_grad_scale(scale, grad):
     return grad * ops.Reciprocal()(scale)
 
 
+accumulate_grad = C.MultitypeFuncGraph("accumulate_grad")
+
+
+@accumulate_grad.register("Tensor", "Tensor")
+def _accumulate_grad(accu_grad, grad):
+    return F.assign_add(accu_grad, F.cast(grad, F.dtype(accu_grad)))
+
+
+reset_grad = C.MultitypeFuncGraph("reset_grad")
+
+
+@reset_grad.register("Tensor")
+def _reset_grad(accu_grad):
+    return F.assign(accu_grad, F.zeros_like(accu_grad))
+
+
+grad_overflow = C.MultitypeFuncGraph("grad_overflow")
+is_finite = ops.IsFinite()
+reduce_all = ops.ReduceAll()
+
+
+@grad_overflow.register("Tensor")
+def _grad_overflow(grad):
+    return 1. - F.cast(reduce_all(is_finite(grad)), mstype.float32)
+
+
 class WithGradCellAscend(nn.TrainOneStepWithLossScaleCell):
-    def __init__(self, network, optimizer, clip_value=0.1):
-        # hacker
-        scaling_sens = Tensor([0.1], dtype=mstype.float32)
-        # manager = nn.DynamicLossScaleUpdateCell(loss_scale_value=2**12, scale_factor=2, scale_window=1000)
-        super(WithGradCellAscend, self).__init__(network, optimizer, scale_sense=scaling_sens)
+    """
+    train one step cell with dynamic loss scaling, by default nn.DynamicLossScaleUpdateCell(2**12, 2, 1000).
+    The steps whose gradients overflow are skipped and counted in overflow_steps.
+    """
+    def __init__(self, network, optimizer, clip_value=0.1, loss_scale_manager=None):
+        if loss_scale_manager is None:
+            loss_scale_manager = nn.DynamicLossScaleUpdateCell(loss_scale_value=2**12, scale_factor=2,
+                                                               scale_window=1000)
+        super(WithGradCellAscend, self).__init__(network, optimizer, scale_sense=loss_scale_manager)
         self.max_grad_norm = clip_value
+        self.overflow_steps = Parameter(Tensor(0, dtype=mstype.int32), name="overflow_steps", requires_grad=False)
+        self.one = Tensor(1, dtype=mstype.int32)
         # hacker
         self.enable_tuple_broaden = True
 
@@ -100,23 +134,37 @@ class WithGradCellAscend(nn.TrainOneStepWithLossScaleCell):
             grads = ops.clip_by_global_norm(grads, clip_norm=self.max_grad_norm)
             loss = F.depend(loss, self.optimizer(grads))
         else:
-            print('current gradients is overflowing, skip this step')
+            loss = F.depend(loss, F.assign_add(self.overflow_steps, self.one))
         return loss
 
 
 # ------------------------------------------------------------
 
 class WithGradCell(nn.Cell):
-    """train one step cell with sense"""
+    """
+    train one step cell with sense.
+    With accumulation_steps > 1 the gradients are summed in device buffers, and every accumulation_steps
+    calls their mean is clipped, reduced between the devices and applied, once.
+    With loss_scale_manager (nn.DynamicLossScaleUpdateCell) the loss is scaled by scale_sense for the
+    backward. The reduced gradients are checked for overflow, which every device sees after the reduction,
+    the overflowing updates are skipped and counted in overflow_steps, and the manager updates the scale.
+    """
 
-    def __init__(self, network, optimizer, clip_value=0.1):
+    def __init__(self, network, optimizer, clip_value=0.1, accumulation_steps=1, loss_scale_manager=None):
         super().__init__()
         self.network = network
         self.network.set_grad()
         self.optimizer = optimizer
         self.weights = self.optimizer.parameters
         self.grad = ops.GradOperation(get_by_list=True, sens_param=True)
-        self.scale_sense = Parameter(Tensor(1., dtype=mstype.float32), name="scale_sense")
+        self.hyper_map = C.HyperMap()
+        self.loss_scale_manager = loss_scale_manager
+        scale = 1. if loss_scale_manager is None else loss_scale_manager.get_loss_scale()
+        self.scale_sense = Parameter(Tensor(scale, dtype=mstype.float32), name="scale_sense")
+        if loss_scale_manager is not None:
+            self.overflow_steps = Parameter(Tensor(0, dtype=mstype.int32), name="overflow_steps",
+                                            requires_grad=False)
+            self.one = Tensor(1, dtype=mstype.int32)
         self.reducer_flag = False
         self.grad_reducer = None
         self.max_grad_norm = clip_value
@@ -130,19 +178,109 @@ class WithGradCell(nn.Cell):
             else:
                 degree = get_group_size()
             self.grad_reducer = nn.DistributedGradReducer(optimizer.parameters, mean, degree)
+        self.accumulation_steps = accumulation_steps
+        if accumulation_steps > 1:
+            self.accu_grads = self.weights.clone(prefix="accu_grads", init='zeros')
+            self.accu_step = Parameter(Tensor(0, dtype=mstype.int32), name="accu_step")
+            self.accu_scale = Tensor(float(accumulation_steps), dtype=mstype.float32)
         # this is a hack
         self.enable_tuple_broaden = True
 
-    @ms_function
-    def clip_backward(self, loss, grads):
+    def warmup(self, *inputs):
+        """
+        run one forward and backward for the shapes of inputs, without updating the weights.
+        In PYNATIVE_MODE this compiles and caches the ms_function graph of the network (DETR.construct)
+        and its backward for these shapes, the matcher and the loss run op by op and cache nothing.
+        """
+        return self.grad(self.network, self.weights)(*inputs, self.scale_sense)
+
+    def reduce_grads(self, grads):
+        if self.loss_scale_manager is not None:
+            grads = self.hyper_map(F.partial(grad_scale, self.scale_sense), grads)
         grads = ops.clip_by_global_norm(grads, clip_norm=self.max_grad_norm)
         if self.reducer_flag:
             grads = self.grad_reducer(grads)
-        loss = ops.depend(loss, self.optimizer(grads))
+        return grads
+
+    def update(self, loss, grads):
+        """optimizer step on the reduced grads, skipped if they overflow"""
+        if self.loss_scale_manager is None:
+            return ops.depend(loss, self.optimizer(grads))
+        overflow = ops.AddN()(self.hyper_map(grad_overflow, grads)) > 0
+        overflow = self.loss_scale_manager(self.scale_sense, overflow)
+        if overflow:
+            loss = F.depend(loss, F.assign_add(self.overflow_steps, self.one))
+        else:
+            loss = F.depend(loss, self.optimizer(grads))
         return loss
 
+    def apply_grads(self, loss, grads):
+        return self.update(loss, self.reduce_grads(grads))
+
+    def accumulate_grads(self, loss, grads):
+        loss = F.depend(loss, self.hyper_map(accumulate_grad, self.accu_grads, grads))
+        step = self.accu_step + 1
+        loss = F.depend(loss, F.assign(self.accu_step, step))
+        if step % self.accumulation_steps == 0:
+            grads = self.hyper_map(F.partial(grad_scale, self.accu_scale), self.accu_grads)
+            loss = self.apply_grads(loss, grads)
+            loss = F.depend(loss, self.hyper_map(reset_grad, self.accu_grads))
+        return loss
+
+    @ms_function
+    def clip_backward(self, loss, grads):
+        return self.apply_grads(loss, grads)
+
+    @ms_function
+    def accumulate_backward(self, loss, grads):
+        return self.accumulate_grads(loss, grads)
+
+    @ms_function
+    def clip_reduce(self, grads):
+        return self.reduce_grads(grads)
+
+    @ms_function
+    def optimizer_update(self, loss, grads):
+        return self.update(loss, grads)
+
+    def timed_construct(self, timer, *inputs):
+        """construct with its phases recorded by timer, clipping and update run as two graphs"""
+        timer.switch('forward')
+        # the matcher records 'matcher' and 'loss'
+        loss = self.network(*inputs)
+        timer.switch('backward', loss)
+        grads = self.grad(self.network, self.weights)(*inputs, self.scale_sense)
+        if self.accumulation_steps > 1:
+            timer.switch('optimizer', grads[0])
+            return self.accumulate_backward(loss, grads)
+        timer.switch('clip_reduce', grads[0])
+        grads = self.clip_reduce(grads)
+        timer.switch('optimizer', grads[0])
+        return self.optimizer_update(loss, grads)
+
     def construct(self, *inputs):
         """construct"""
+        timer = current_timer()
+        if timer is not None:
+            return self.timed_construct(timer, *inputs)
         loss = self.network(*inputs)
         grads = self.grad(self.network, self.weights)(*inputs, self.scale_sense)
+        if self.accumulation_steps > 1:
+            return self.accumulate_backward(loss, grads)
         return self.clip_backward(loss, grads)
+
+
+class WithGradCellGraph(WithGradCell):
+    """WithGradCell for GRAPH_MODE: forward, loss, backward and update compile into one graph"""
+
+    def warmup(self, *inputs):
+        """compile the train graph (construct) for the shapes of inputs, without running it"""
+        return self.compile(*inputs)
+
+    def construct(self, *inputs):
+        """construct"""
+        loss = self.network(*inputs)
+        grads = self.grad(self.network, self.weights)(*inputs, self.scale_sense)
+        if self.accumulation_steps > 1:
+            return self.accumulate_grads(loss, grads)
+        return self.apply_grads(loss, grads)
@@ -0,0 +1,104 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Checkpoints written on a background thread."""
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+import mindspore as ms
+from mindspore import Tensor
+
+from src.tools.tracer import span
+
+
+class CheckpointRetention(object):
+    """on_commit callback keeping the last keep_num checkpoints"""
+    def __init__(self, keep_num=4):
+        self.keep_num = keep_num
+        self.ckpt_deque = deque()
+
+    def __call__(self, ckpt_path):
+        if len(self.ckpt_deque) >= self.keep_num:
+            pre_ckpt_path = self.ckpt_deque.popleft()
+            if os.path.exists(pre_ckpt_path):
+                os.remove(pre_ckpt_path)
+        self.ckpt_deque.append(ckpt_path)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    save() only copies the parameters to host memory. Serialization, fsync and the atomic rename
+    run on a background thread, then on_commit(path) is called there. At most max_pending
+    snapshots wait for the thread, save() blocks beyond. close() waits for the pending writes.
+    save(notify=False) skips on_commit, for a checkpoint overwritten in place by the next one.
+    """
+    def __init__(self, max_pending=1, on_commit=None):
+        self.on_commit = on_commit
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, net, ckpt_path, append_dict=None, notify=True):
+        self._raise_error()
+        start_time = time.time()
+        with span('checkpoint_snapshot', 'checkpoint'):
+            params = [{'name': param.name, 'data': Tensor(param.asnumpy())} for param in net.get_parameters()]
+        snapshot_time = time.time() - start_time
+        self.queue.put((params, ckpt_path, append_dict, notify, start_time, snapshot_time))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            params, ckpt_path, append_dict, notify, start_time, snapshot_time = job
+            try:
+                # save_checkpoint appends .ckpt to the names that do not end with it
+                root = ckpt_path[:-len('.ckpt')] if ckpt_path.endswith('.ckpt') else ckpt_path
+                tmp_path = root + '.tmp.ckpt'
+                with span('checkpoint_write', 'checkpoint', path=ckpt_path):
+                    ms.save_checkpoint(params, tmp_path, append_dict=append_dict)
+                    fsync_path(tmp_path)
+                    os.replace(tmp_path, ckpt_path)
+                    fsync_path(os.path.dirname(os.path.abspath(ckpt_path)))
+                if notify and self.on_commit is not None:
+                    self.on_commit(ckpt_path)
+                print(f'checkpoint {ckpt_path}: snapshot {snapshot_time:.2f}s, '
+                      f'written in {time.time() - start_time:.2f}s', flush=True)
+            except Exception as e:  # pylint: disable=broad-except
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writing failed') from error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
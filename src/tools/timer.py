@@ -0,0 +1,118 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Wall time of the phases of the training steps."""
+
+import json
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+# order of the phases in the log line
+PHASES = ('data_wait', 'h2d', 'step', 'forward', 'matcher', 'loss', 'backward', 'clip_reduce', 'optimizer', 'sync')
+PERCENTILES = (50, 90, 99)
+
+_timer = None
+
+
+class PhaseTimer(object):
+    """
+    Per-step time of each phase, over the last window_size steps.
+
+    A step goes from begin() to end(). switch(phase) charges the time since the previous switch to the
+    current phase and makes phase the current one, so nested phases (phase()) are not counted twice.
+    The device runs asynchronously: without sync a phase only times the launch of its ops, and the
+    wait shows up in the next phase reading a result (the matcher, the loss sync). With sync, switch
+    first waits for the given tensors, which gives device times but slows the steps down.
+    """
+    def __init__(self, window_size=100, sync=False):
+        self.window_size = window_size
+        self.sync = sync
+        self.times = {}
+        self.step_times = {}
+        self.current = None
+        self.last_time = None
+
+    def begin(self):
+        self.step_times = {}
+        self.current = None
+        self.last_time = time.time()
+
+    def add(self, phase, seconds):
+        """add a time measured outside of the timer"""
+        self.step_times[phase] = self.step_times.get(phase, 0.) + seconds
+
+    def switch(self, phase, *tensors):
+        if self.sync:
+            for tensor in tensors:
+                tensor.asnumpy()
+        now = time.time()
+        if self.current is not None:
+            self.add(self.current, now - self.last_time)
+        self.current = phase
+        self.last_time = now
+
+    @contextmanager
+    def phase(self, phase, *tensors, then=None):
+        """time the block as phase, then switch to then, by default to the phase it interrupted"""
+        previous = self.current
+        self.switch(phase, *tensors)
+        try:
+            yield
+        finally:
+            self.switch(then or previous)
+
+    def end(self):
+        self.switch(None)
+        for phase, seconds in self.step_times.items():
+            if phase not in self.times:
+                self.times[phase] = deque(maxlen=self.window_size)
+            self.times[phase].append(seconds)
+
+    def summary(self):
+        """{phase: {'mean': ms, 'p50': ms, ...}} over the window"""
+        phases = sorted(self.times, key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES))
+        summary = {}
+        for phase in phases:
+            times = np.array(self.times[phase]) * 1000
+            summary[phase] = {'mean': float(times.mean())}
+            for q in PERCENTILES:
+                summary[phase][f'p{q}'] = float(np.percentile(times, q))
+        return summary
+
+    def format(self):
+        """p50/p90 of each phase in ms, for the log line"""
+        return ' '.join(f"{phase}:{s['p50']:.1f}/{s['p90']:.1f}" for phase, s in self.summary().items())
+
+    def dump(self, path, **info):
+        """append the summary and info (epoch, step...) to path as a line of JSON"""
+        with open(path, 'a') as f:
+            f.write(json.dumps({**info, 'window': self.window_size, 'phases_ms': self.summary()}) + '\n')
+
+
+def set_timer(timer):
+    """make timer the one recording the phases of the cells, None to stop recording"""
+    global _timer
+    _timer = timer
+
+
+def current_timer():
+    return _timer
+
+
+def phase(name, *tensors, then=None):
+    """context timing a phase with the current timer, if any"""
+    if _timer is None:
+        return nullcontext()
+    return _timer.phase(name, *tensors, then=then)
@@ -0,0 +1,176 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Host spans of a range of steps as a Chrome trace (chrome://tracing, ui.perfetto.dev)."""
+
+import os
+import glob
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+_tracer = None
+
+
+def parse_trace_steps(args):
+    """--trace_steps 'start,end' -> (start, end)"""
+    start, end = (int(s) for s in args.trace_steps.split(','))
+    if not 0 <= start < end:
+        raise ValueError(f'--trace_steps {args.trace_steps}: expected start,end with 0 <= start < end')
+    return start, end
+
+
+class Tracer(object):
+    """
+    Record the spans of the steps start to end - 1, or from begin() on, and write them to path
+    at close(). The spans are complete events ('X') of this process, one track per thread:
+    the training loop, the pipeline worker threads, the checkpoint writer. Pipeline workers running
+    in processes (python_multiprocessing) are not traced.
+    With profile_dir the MindSpore Profiler records the device over the steps start to end - 1 (it is
+    stopped at step end, not restarted by begin()), its timeline
+    is added to the trace as a second process, shifted to start with the first traced step
+    (the device and host clocks are not aligned).
+    """
+    def __init__(self, path, start, end, profile_dir=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.active = False
+        self.done = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.profiler_started = False
+        self.profiler_stopped = False
+        self.start_ts = None
+        if profile_dir:
+            from mindspore.profiler import Profiler
+            self.profiler = Profiler(output_path=profile_dir, start_profile=False)
+
+    def step(self, step):
+        """called at the beginning of each step, records from step start and pauses at step end"""
+        if step >= self.end:
+            self.active = False
+            self.stop_profiler()
+        elif step >= self.start:
+            self.begin()
+
+    def begin(self):
+        if self.done or self.active:
+            return
+        self.active = True
+        if self.start_ts is None:
+            self.start_ts = time.time() * 1e6
+        if self.profiler is not None and not self.profiler_started:
+            self.profiler_started = True
+            self.profiler.start()
+
+    def stop_profiler(self):
+        if self.profiler_started and not self.profiler_stopped:
+            self.profiler_stopped = True
+            self.profiler.stop()
+
+    def add(self, name, cat, start_time, end_time, **args):
+        """add a span measured outside of the tracer, times from time.time()"""
+        if not self.active:
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                 'ts': start_time * 1e6, 'dur': (end_time - start_time) * 1e6}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start_time, time.time(), **args)
+
+    def thread_names(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        tids = {event['tid'] for event in self.events}
+        return [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                 'args': {'name': names.get(tid, str(tid))}} for tid in tids]
+
+    def device_events(self):
+        """events of the profiler timeline, moved to start at the first traced step"""
+        self.profiler.analyse()
+        events = []
+        for path in glob.glob(os.path.join(self.profile_dir, '**', '*timeline_display*.json'), recursive=True):
+            with open(path) as f:
+                timeline = json.load(f)
+            if isinstance(timeline, dict):
+                timeline = timeline.get('traceEvents', [])
+            events.extend(event for event in timeline if isinstance(event, dict))
+        if not events:
+            print(f'no profiler timeline found in {self.profile_dir}')
+            return []
+        first_ts = min(float(event['ts']) for event in events if 'ts' in event)
+        for event in events:
+            event['pid'] = f"device {event.get('pid', '')}"
+            if 'ts' in event:
+                event['ts'] = float(event['ts']) - first_ts + self.start_ts
+        return events
+
+    def close(self):
+        """stop recording and write the trace"""
+        if self.done:
+            return
+        self.done = True
+        self.active = False
+        if self.start_ts is None:
+            return
+        events = self.thread_names() + self.events
+        if self.profiler_started:
+            self.stop_profiler()
+            events += self.device_events()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print(f'trace of steps {self.start} to {self.end - 1}: {len(self.events)} host spans in {self.path}',
+              flush=True)
+
+
+def set_tracer(tracer):
+    """make tracer the one recording the spans, None to stop recording"""
+    global _tracer
+    _tracer = tracer
+
+
+def current_tracer():
+    return _tracer
+
+
+def span(name, cat, **args):
+    """context recording a span with the current tracer, if any"""
+    if _tracer is None or not _tracer.active:
+        return nullcontext()
+    return _tracer.span(name, cat, **args)
+
+
+def traced(name, cat):
+    """decorator recording the calls of a function as spans"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,106 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""The composed box affine gives the boxes of the per-transform implementations it replaced."""
+
+import numpy as np
+import pytest
+
+from src.data.transform import hflip_target, resize_target, crop_target, apply_box_affine
+
+
+def old_hflip_target(target, w):
+    target = target.copy()
+    target['boxes'] = target['boxes'][:, [2, 1, 0, 3]] * np.array([-1, 1, -1, 1]) + np.array([w, 0, w, 0])
+    return target
+
+
+def old_resize_target(target, size, new_size):
+    (h, w), (nh, nw) = size, new_size
+    target = target.copy()
+    ratio_width, ratio_height = float(nw) / float(w), float(nh) / float(h)
+    target['boxes'] = target['boxes'] * np.array([ratio_width, ratio_height, ratio_width, ratio_height])
+    target['size'] = (nh, nw)
+    return target
+
+
+def old_crop_target(ori_target, region):
+    i, j, h, w = region
+    target = ori_target.copy()
+    target['size'] = np.array([h, w])
+    cropped_boxes = target['boxes'] - np.array([j, i, j, i])
+    cropped_boxes = np.minimum(cropped_boxes.reshape(-1, 2, 2), np.array([w, h])).clip(0)
+    keep = np.all(cropped_boxes[:, 1, :] > cropped_boxes[:, 0, :], axis=1)
+    target['boxes'] = cropped_boxes.reshape(-1, 4)[keep]
+    target['labels'] = target['labels'][keep]
+    if len(target['labels']) == 0:
+        return None
+    return target
+
+
+def random_target(rng, h, w, num_boxes):
+    xy = rng.uniform(0, 1, (num_boxes, 2, 2)) * np.array([w, h])
+    boxes = np.concatenate([xy.min(1), xy.max(1)], axis=1)
+    return {'boxes': boxes, 'labels': rng.randint(1, 91, num_boxes), 'size': (h, w)}
+
+
+def random_chain(rng, h, w):
+    """a random sequence of flips, resizes and crops of an h x w image"""
+    chain = []
+    for _ in range(rng.randint(1, 5)):
+        op = rng.choice(['hflip', 'resize', 'crop'])
+        if op == 'hflip':
+            chain.append((op, w))
+        elif op == 'resize':
+            nh, nw = rng.randint(10, 200, 2)
+            chain.append((op, (h, w), (nh, nw)))
+            h, w = nh, nw
+        else:
+            ch, cw = rng.randint(1, h + 1), rng.randint(1, w + 1)
+            i, j = rng.randint(0, h - ch + 1), rng.randint(0, w - cw + 1)
+            chain.append((op, (i, j, ch, cw)))
+            h, w = ch, cw
+    return chain
+
+
+def run_chain(chain, target, hflip, resize, crop):
+    for op, *args in chain:
+        target = {'hflip': hflip, 'resize': resize, 'crop': crop}[op](target, *args)
+        if target is None:
+            return None
+    return target
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_affine_matches_old_transforms(seed):
+    rng = np.random.RandomState(seed)
+    h, w = rng.randint(10, 200, 2)
+    target = random_target(rng, h, w, rng.randint(1, 6))
+    chain = random_chain(rng, h, w)
+
+    expected = run_chain(chain, target, old_hflip_target, old_resize_target, old_crop_target)
+    result = run_chain(chain, target, hflip_target, resize_target, crop_target)
+    assert (result is None) == (expected is None)
+    if expected is None:
+        return
+    result = apply_box_affine(result)
+    assert 'box_affine' not in result and 'cropped' not in result
+    np.testing.assert_allclose(result['boxes'], expected['boxes'], atol=1e-6)
+    np.testing.assert_array_equal(result['labels'], expected['labels'])
+    np.testing.assert_array_equal(result['size'], expected['size'])
+
+
+def test_no_transform_leaves_target():
+    target = random_target(np.random.RandomState(0), 20, 30, 3)
+    result = apply_box_affine(target)
+    np.testing.assert_array_equal(result['boxes'], target['boxes'])
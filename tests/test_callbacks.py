@@ -0,0 +1,79 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Checkpoints and log lines of the data sink training, one callback call per sink."""
+
+import sys
+import types
+import importlib
+import pytest
+
+
+class RunContext(object):
+    def __init__(self, cur_step_num, net_outputs=None):
+        self.cb_params = types.SimpleNamespace(cur_step_num=cur_step_num, net_outputs=net_outputs)
+
+    def original_args(self):
+        return self.cb_params
+
+
+class Writer(object):
+    def __init__(self):
+        self.saved = []
+
+    def save(self, net, ckpt_path, append_dict=None, notify=True):
+        self.saved.append((ckpt_path, append_dict))
+
+
+@pytest.fixture(name='callbacks')
+def fixture_callbacks(monkeypatch):
+    try:
+        import mindspore.train.callback  # pylint: disable=unused-import
+    except ImportError:
+        callback = types.ModuleType('mindspore.train.callback')
+        callback.Callback = type('Callback', (object,), {})
+        for name, module in (('mindspore', types.ModuleType('mindspore')),
+                             ('mindspore.train', types.ModuleType('mindspore.train')),
+                             ('mindspore.train.callback', callback)):
+            monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'src.tools.callbacks', raising=False)
+    return importlib.import_module('src.tools.callbacks')
+
+
+def test_checkpoint_once_per_dataset_epoch(callbacks):
+    # 4 steps per sink, 10 per dataset epoch: some sinks end past the end of an epoch
+    writer = Writer()
+    callback = callbacks.EpochCheckpoint('net', writer, sink_size=4, dataset_size=10, start_epoch=2, output_dir='out')
+    for step in range(4, 44, 4):
+        callback.epoch_end(RunContext(step))
+    assert writer.saved == [(f'out/detr_epoch_{e}.ckpt', {'epoch': e + 1, 'step': 0}) for e in (2, 3, 4, 5)]
+
+
+def test_checkpoint_sink_of_whole_epochs(callbacks):
+    writer = Writer()
+    callback = callbacks.EpochCheckpoint('net', writer, sink_size=5, dataset_size=5, start_epoch=0, output_dir='out')
+    for step in range(5, 20, 5):
+        callback.epoch_end(RunContext(step))
+    assert [path for path, _ in writer.saved] == [f'out/detr_epoch_{e}.ckpt' for e in range(3)]
+
+
+def test_monitor_logs_last_step_of_sink(callbacks, capsys):
+    loss = types.SimpleNamespace(asnumpy=lambda: 0.5)
+    lr = [0.1 * k for k in range(20)]
+    monitor = callbacks.SinkMonitor(2, 4, 10, 1, 3, lr, lr, accumulation_steps=2)
+    monitor.epoch_begin(RunContext(4))
+    monitor.epoch_end(RunContext(8, loss))
+    # step 1 * 10 + 8 - 1 = 17 of the training: epoch 1, iteration 7, optimizer update 8
+    out = capsys.readouterr().out
+    assert out.startswith('epoch[1/3], iter[7/10], loss:0.5000, ')
+    assert out.rstrip().endswith(f'lr:[{lr[8]}/{lr[8]}]')
@@ -0,0 +1,95 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""AsyncCheckpointWriter commits complete checkpoints and applies the retention after each one."""
+
+import os
+import sys
+import types
+import pickle
+import importlib
+import numpy as np
+import pytest
+
+
+def stub_mindspore():
+    """the parts of mindspore the writer uses, save_checkpoint appends .ckpt like the real one"""
+    ms = types.ModuleType('mindspore')
+
+    class Tensor(object):
+        def __init__(self, data):
+            self.data = np.array(data)
+
+        def asnumpy(self):
+            return self.data
+
+    def save_checkpoint(params, ckpt_file_name, append_dict=None):
+        if not ckpt_file_name.endswith('.ckpt'):
+            ckpt_file_name += '.ckpt'
+        with open(ckpt_file_name, 'wb') as f:
+            pickle.dump(({p['name']: p['data'].asnumpy() for p in params}, append_dict), f)
+
+    def load_checkpoint(ckpt_file_name):
+        with open(ckpt_file_name, 'rb') as f:
+            params, append_dict = pickle.load(f)
+        return {**{k: Tensor(v) for k, v in params.items()}, **{k: Tensor(v) for k, v in (append_dict or {}).items()}}
+
+    ms.Tensor = Tensor
+    ms.save_checkpoint = save_checkpoint
+    ms.load_checkpoint = load_checkpoint
+    return ms
+
+
+@pytest.fixture(name='ms')
+def fixture_ms(monkeypatch):
+    try:
+        import mindspore as ms
+    except ImportError:
+        ms = stub_mindspore()
+        monkeypatch.setitem(sys.modules, 'mindspore', ms)
+    monkeypatch.delitem(sys.modules, 'src.tools.checkpoint', raising=False)
+    return ms
+
+
+class Net(object):
+    def __init__(self, params):
+        self.params = [types.SimpleNamespace(name=name, asnumpy=lambda v=value: v) for name, value in params.items()]
+
+    def get_parameters(self):
+        return self.params
+
+
+def test_save_round_trip_and_retention(ms, tmp_path):
+    checkpoint = importlib.import_module('src.tools.checkpoint')
+    writer = checkpoint.AsyncCheckpointWriter(on_commit=checkpoint.CheckpointRetention(keep_num=2))
+    paths = []
+    for e in range(3):
+        params = {'w': np.full((2, 3), e, np.float32), 'b': np.arange(3, dtype=np.float32) + e}
+        paths.append(os.path.join(str(tmp_path), f'detr_epoch_{e}.ckpt'))
+        writer.save(Net(params), paths[-1], append_dict={'epoch': e + 1, 'step': 0})
+    writer.save(Net(params), os.path.join(str(tmp_path), 'detr_last.ckpt'), notify=False)
+    writer.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ['detr_epoch_1.ckpt', 'detr_epoch_2.ckpt', 'detr_last.ckpt']
+    ckpt = ms.load_checkpoint(paths[-1])
+    np.testing.assert_array_equal(ckpt['w'].asnumpy(), np.full((2, 3), 2, np.float32))
+    np.testing.assert_array_equal(ckpt['b'].asnumpy(), np.arange(3, dtype=np.float32) + 2)
+    assert int(ckpt['epoch'].asnumpy()) == 3
+
+
+def test_write_error_raised_on_close(ms, tmp_path):
+    checkpoint = importlib.import_module('src.tools.checkpoint')
+    writer = checkpoint.AsyncCheckpointWriter()
+    writer.save(Net({'w': np.zeros(2, np.float32)}), os.path.join(str(tmp_path), 'missing', 'a.ckpt'))
+    with pytest.raises(RuntimeError):
+        writer.close()
@@ -0,0 +1,90 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""The cached columnar annotation index equals the one parsed from the json."""
+
+import os
+import copy
+import json
+import multiprocessing
+import numpy as np
+
+from src.data import coco_index
+from src.data.coco_index import CocoIndex, load_coco_index
+
+ANNOTATIONS = {
+    'images': [{'id': 7, 'file_name': 'a.jpg', 'height': 10, 'width': 20},
+               {'id': 3, 'file_name': 'b.jpg', 'height': 30, 'width': 40},
+               {'id': 5, 'file_name': 'c.jpg', 'height': 50, 'width': 60}],
+    'annotations': [{'id': 1, 'image_id': 3, 'bbox': [1, 2, 3, 4], 'area': 12., 'category_id': 2, 'iscrowd': 0},
+                    {'id': 2, 'image_id': 7, 'bbox': [5, 6, 7, 8], 'area': 56., 'category_id': 1, 'iscrowd': 1},
+                    {'id': 4, 'image_id': 3, 'bbox': [0, 0, 1, 1], 'area': 1., 'category_id': 1, 'iscrowd': 0}],
+    'categories': [{'id': 1, 'name': 'cat'}, {'id': 2, 'name': 'dog'}],
+}
+
+
+def write_json(tmp_path, annotations=None):
+    anno_json = os.path.join(str(tmp_path), 'instances.json')
+    with open(anno_json, 'w') as f:
+        json.dump(annotations or ANNOTATIONS, f)
+    return anno_json
+
+
+def assert_same_index(index, expected):
+    for name in CocoIndex.FIELDS:
+        np.testing.assert_array_equal(getattr(index, name), getattr(expected, name), err_msg=name)
+
+
+def test_cached_index_equals_json(tmp_path):
+    anno_json = write_json(tmp_path)
+    expected = CocoIndex.from_json(anno_json)
+    assert expected.image_size(3) == (30, 40)
+    # annotations grouped by image, in json order
+    np.testing.assert_array_equal(expected.ann_ids[expected.annotations(expected.row(3))], [1, 4])
+
+    assert_same_index(load_coco_index(anno_json), expected)
+    cached = load_coco_index(anno_json)
+    assert_same_index(cached, expected)
+    assert len([f for f in os.listdir(str(tmp_path)) if f.endswith('.npz')]) == 1
+
+
+def test_hash_only_on_stat_change(tmp_path, monkeypatch):
+    anno_json = write_json(tmp_path)
+    load_coco_index(anno_json)
+
+    calls = []
+    file_hash = coco_index.file_hash
+    monkeypatch.setattr(coco_index, 'file_hash', lambda path: calls.append(path) or file_hash(path))
+    load_coco_index(anno_json)
+    assert not calls
+
+    annotations = copy.deepcopy(ANNOTATIONS)
+    annotations['images'][0]['height'] = 11
+    write_json(tmp_path, annotations)
+    os.utime(anno_json, ns=(0, os.stat(anno_json).st_mtime_ns + 1))
+    index = load_coco_index(anno_json)
+    assert calls
+    assert index.image_size(7) == (11, 20)
+
+
+def test_concurrent_cache_writes(tmp_path):
+    anno_json = write_json(tmp_path)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=load_coco_index, args=(anno_json,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.tmp')]
+    assert_same_index(load_coco_index(anno_json), CocoIndex.from_json(anno_json))
@@ -0,0 +1,74 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""The planned decode gives the targets and sizes of the unplanned augmentation chain."""
+
+import io
+import random
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.data.transform import (Compose, RandomSelect, RandomHorizontalFlip, RandomResize, RandomSizeCrop,
+                                CropAwareDecode, apply_box_affine)
+
+SCALES = [64, 80, 96]
+MAX_SIZE = 160
+CROP_RESIZE_SIZES = [60, 90]
+CROP_MIN, CROP_MAX = 24, 60
+
+
+def encoded_image(h, w):
+    """a smooth jpeg, so that the two resamplings give close pixels"""
+    y, x = np.mgrid[:h, :w]
+    image = np.stack([255 * x / w, 255 * y / h, 128 + 64 * np.sin(x / 7.) * np.cos(y / 5.)], axis=-1)
+    buf = io.BytesIO()
+    Image.fromarray(image.astype(np.uint8)).save(buf, format='JPEG', quality=95)
+    return buf.getvalue()
+
+
+def unplanned_chain():
+    return Compose([
+        RandomHorizontalFlip(),
+        RandomSelect(
+            RandomResize(SCALES, max_size=MAX_SIZE),
+            Compose([RandomResize(CROP_RESIZE_SIZES), RandomSizeCrop(CROP_MIN, CROP_MAX),
+                     RandomResize(SCALES, max_size=MAX_SIZE)])),
+    ])
+
+
+def seed(value):
+    random.seed(value)
+    np.random.seed(value)
+
+
+@pytest.mark.parametrize('value', range(40))
+def test_planned_decode_matches_chain(value):
+    rng = np.random.RandomState(value)
+    h, w = rng.randint(80, 240, 2)
+    xy = rng.uniform(0, 1, (4, 2, 2)) * np.array([w, h])
+    target = {'boxes': np.concatenate([xy.min(1), xy.max(1)], axis=1), 'labels': np.arange(1, 5), 'size': (h, w)}
+    data = encoded_image(h, w)
+
+    seed(value)
+    expected_image, expected = unplanned_chain()(np.asarray(Image.open(io.BytesIO(data)).convert('RGB')), target)
+    expected = apply_box_affine(expected)
+    seed(value)
+    image, result = CropAwareDecode(SCALES, MAX_SIZE, CROP_RESIZE_SIZES, CROP_MIN, CROP_MAX)(data, target)
+    result = apply_box_affine(result)
+
+    assert image.shape == expected_image.shape
+    np.testing.assert_array_equal(result['size'], expected['size'])
+    np.testing.assert_allclose(result['boxes'], expected['boxes'], atol=1e-6)
+    np.testing.assert_array_equal(result['labels'], expected['labels'])
+    assert np.abs(image.astype(np.float32) - expected_image).mean() < 4
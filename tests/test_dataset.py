@@ -0,0 +1,69 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Grouped batching of the training pipeline."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mindspore')
+import mindspore.dataset as de  # pylint: disable=wrong-import-position
+
+from src.data.dataset import TARGET_PAD_INFO, group_batch, map_keep_size, pack_targets  # pylint: disable=wrong-import-position
+
+
+def image_dataset(sizes):
+    def generator():
+        for h, w in sizes:
+            yield np.ones((3, h, w), np.uint8), np.zeros((h, w), np.uint8)
+    return de.GeneratorDataset(generator, ["image", "mask"], shuffle=False)
+
+
+def test_single_group_batches():
+    # a single shape bucket, e.g. --shape_buckets 960x960 with --max_size 960
+    ds = group_batch(image_dataset([(8, 8)] * 5), 2, lambda image: 0, 1)
+    batches = list(ds.create_tuple_iterator(output_numpy=True))
+    assert ds.get_dataset_size() == len(batches) == 2
+    assert all(image.shape == (2, 3, 8, 8) for image, _ in batches)
+
+
+def test_groups_are_padded_to_their_largest_member():
+    sizes = [(8, 4), (4, 8), (6, 4), (4, 6), (8, 2), (2, 8)]
+    ds = group_batch(image_dataset(sizes), 2, lambda image: int(image.shape[2] > image.shape[1]), 2)
+    # (6 samples - 2 groups * 1) // 2: every group always fills a batch
+    batches = list(ds.create_tuple_iterator(output_numpy=True))
+    assert ds.get_dataset_size() == len(batches) == 2
+    shapes = sorted(image.shape for image, _ in batches)
+    assert shapes == [(2, 3, 4, 8), (2, 3, 8, 4)]
+    for image, mask in batches:
+        assert mask.shape == image.shape[:1] + image.shape[2:]
+
+
+def test_packed_targets_keep_dataset_size():
+    def generator():
+        for i, (h, w) in enumerate([(8, 4), (4, 8), (6, 4), (4, 6), (8, 2), (2, 8)]):
+            num_boxes = i % 3 + 1
+            yield (np.ones((3, h, w), np.uint8), np.zeros((h, w), np.uint8), np.ones((num_boxes, 4), np.float32),
+                   np.ones(num_boxes, np.int32), np.ones(num_boxes, np.bool_))
+    ds = de.GeneratorDataset(generator, ["image", "mask", "boxes", "labels", "valid"], shuffle=False)
+    ds = group_batch(ds, 2, lambda image: int(image.shape[2] > image.shape[1]), 2, TARGET_PAD_INFO)
+    ds = map_keep_size(ds, input_columns=["boxes", "labels", "valid"],
+                       output_columns=["boxes", "labels", "num_boxes"],
+                       column_order=["image", "mask", "boxes", "labels", "num_boxes"],
+                       operations=pack_targets)
+    # the size is set on the packing node, get_dataset_size does not run the pipeline
+    assert ds.dataset_size == 2
+    batches = list(ds.create_tuple_iterator(output_numpy=True))
+    assert len(batches) == 2
+    for _, _, boxes, labels, num_boxes in batches:
+        assert boxes.shape == (num_boxes.sum(), 4) and labels.shape == (num_boxes.sum(),)
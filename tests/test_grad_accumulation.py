@@ -0,0 +1,65 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Accumulating the gradients of two batches gives the update of their mean gradient."""
+
+import numpy as np
+import pytest
+
+ms = pytest.importorskip('mindspore')
+
+
+def make_cells(accumulation_steps):
+    from mindspore import nn, context
+    from src.tools.cell import WithGradCell
+
+    class Loss(nn.Cell):
+        def __init__(self):
+            super(Loss, self).__init__()
+            self.dense = nn.Dense(3, 1, weight_init=ms.Tensor(np.array([[0.5, -1., 2.]], np.float32)),
+                                  bias_init='zeros')
+            self.mse = nn.MSELoss()
+
+        def construct(self, x, y):
+            return self.mse(self.dense(x), y)
+
+    context.set_context(mode=context.PYNATIVE_MODE)
+    net = Loss()
+    optimizer = nn.SGD(net.trainable_params(), learning_rate=0.1)
+    return net, WithGradCell(net, optimizer, clip_value=1e6, accumulation_steps=accumulation_steps)
+
+
+def weights(net):
+    return [param.asnumpy().copy() for param in net.trainable_params()]
+
+
+def test_two_accumulated_batches_equal_one_mean_step():
+    rng = np.random.RandomState(0)
+    x = rng.randn(2, 4, 3).astype(np.float32)
+    y = rng.randn(2, 4, 1).astype(np.float32)
+
+    net, cell = make_cells(2)
+    initial = weights(net)
+    cell(ms.Tensor(x[0]), ms.Tensor(y[0]))
+    for before, after in zip(initial, weights(net)):
+        np.testing.assert_array_equal(before, after)
+    cell(ms.Tensor(x[1]), ms.Tensor(y[1]))
+
+    # same batch sizes: the loss of the concatenated batch is the mean of the two losses
+    expected_net, expected_cell = make_cells(1)
+    expected_cell(ms.Tensor(x.reshape(-1, 3)), ms.Tensor(y.reshape(-1, 1)))
+    for result, expected in zip(weights(net), weights(expected_net)):
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+    # the buffers are reset for the next accumulation
+    for accu_grad in cell.accu_grads:
+        assert not accu_grad.asnumpy().any()
@@ -0,0 +1,89 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Hungarian matching of packed targets equals the matching of the targets padded to max_boxes."""
+
+import os
+import importlib.util
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# loaded by path: the src.DETR package imports the mindspore model
+_spec = importlib.util.spec_from_file_location(
+    'hungarian', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'DETR', 'hungarian.py'))
+hungarian = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(hungarian)
+
+NUM_QUERIES, NUM_CLASSES, MAX_BOXES = 10, 92, 6
+COSTS = (1., 5., 2.)
+
+
+def random_batch(rng, num_boxes):
+    bs = len(num_boxes)
+    pred_logits = rng.randn(bs, NUM_QUERIES, NUM_CLASSES).astype(np.float32)
+    pred_boxes = rng.uniform(0.2, 0.8, (bs, NUM_QUERIES, 4)).astype(np.float32) * [1, 1, 0.5, 0.5]
+    total = sum(num_boxes)
+    boxes = rng.uniform(0.2, 0.8, (total, 4)).astype(np.float32) * [1, 1, 0.5, 0.5]
+    labels = rng.randint(0, NUM_CLASSES - 1, total)
+    return pred_logits, pred_boxes, boxes, labels
+
+
+def pad(boxes, labels, num_boxes):
+    bs = len(num_boxes)
+    padded_boxes = np.zeros((bs, MAX_BOXES, 4), np.float32)
+    padded_labels = np.zeros((bs, MAX_BOXES), np.int32)
+    valid = np.zeros((bs, MAX_BOXES), np.float32)
+    offset = 0
+    for i, n in enumerate(num_boxes):
+        padded_boxes[i, :n] = boxes[offset:offset + n]
+        padded_labels[i, :n] = labels[offset:offset + n]
+        valid[i, :n] = 1
+        offset += n
+    return padded_boxes, padded_labels, valid
+
+
+def test_packed_equals_padded():
+    rng = np.random.RandomState(0)
+    for num_boxes in ([3, 0, 6, 1], [1], [0, 2], [6, 6]):
+        pred_logits, pred_boxes, boxes, labels = random_batch(rng, num_boxes)
+        packed = hungarian.hungarian_match(pred_logits, pred_boxes, boxes, labels,
+                                           np.array(num_boxes, np.int32), *COSTS)
+        padded = hungarian.hungarian_match(pred_logits, pred_boxes, *pad(boxes, labels, num_boxes), *COSTS)
+        for a, b in zip(packed, padded):
+            np.testing.assert_array_equal(a, b)
+        assert packed[2].sum(1).tolist() == num_boxes
+
+
+def test_matches_scipy_per_image():
+    rng = np.random.RandomState(1)
+    num_boxes = [2, 5, 3]
+    pred_logits, pred_boxes, boxes, labels = random_batch(rng, num_boxes)
+    target_classes, target_boxes, boxes_valid = hungarian.hungarian_match(
+        pred_logits, pred_boxes, boxes, labels, np.array(num_boxes), *COSTS)
+
+    cost_class, cost_bbox, cost_giou = COSTS
+    offset = 0
+    for i, n in enumerate(num_boxes):
+        tgt_boxes, tgt_labels = boxes[offset:offset + n], labels[offset:offset + n]
+        offset += n
+        prob = hungarian.softmax(pred_logits[i], -1)
+        cost = (cost_bbox * np.abs(pred_boxes[i][:, None] - tgt_boxes[None]).sum(-1)
+                - cost_class * prob[:, tgt_labels]
+                - cost_giou * hungarian.GIOU(hungarian.box_cxcywh_to_xyxy(pred_boxes[i]),
+                                             hungarian.box_cxcywh_to_xyxy(tgt_boxes)))
+        rows, cols = linear_sum_assignment(cost)
+        expected_classes = np.full(NUM_QUERIES, NUM_CLASSES - 1)
+        expected_classes[rows] = tgt_labels[cols]
+        np.testing.assert_array_equal(target_classes[i], expected_classes)
+        np.testing.assert_allclose(target_boxes[i][rows], tgt_boxes[cols])
+        np.testing.assert_array_equal(np.flatnonzero(boxes_valid[i]), np.sort(rows))
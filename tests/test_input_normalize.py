@@ -0,0 +1,41 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""uint8 images normalized on device match the images normalized by the pipeline."""
+
+import numpy as np
+import pytest
+
+from src.data.transform import Pad
+
+ms = pytest.importorskip('mindspore')
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+def test_uint8_matches_float_path_on_padded_batch():
+    from src.DETR.detr import InputNormalize
+
+    rng = np.random.RandomState(0)
+    images, masks, expected = [], [], []
+    for h, w in ((20, 30), (32, 17)):
+        img = rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+        padded, target = Pad(32, 40)(img, {})
+        images.append(padded)
+        masks.append(target['mask'].astype(np.float32))
+        normalized, _ = Pad(32, 40, mean=MEAN, std=STD)(img, {})
+        expected.append(normalized)
+
+    out = InputNormalize(MEAN, STD)(ms.Tensor(np.stack(images)), ms.Tensor(np.stack(masks))).asnumpy()
+    np.testing.assert_allclose(out, np.stack(expected), atol=1e-5)
@@ -0,0 +1,83 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Padded images and masks, with and without the reused arena buffers."""
+
+import numpy as np
+import pytest
+
+from src.data.transform import Pad, DynamicPad, BucketPad, BufferArena
+
+SIZES = ((20, 30), (32, 17), (8, 40), (32, 40), (5, 5))
+
+
+def random_image(rng, h, w):
+    return rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+
+
+def test_pad_uint8():
+    img = random_image(np.random.RandomState(0), 20, 30)
+    new_img, target = Pad(32, 40)(img, {})
+    assert new_img.dtype == np.uint8 and new_img.shape == (3, 32, 40)
+    np.testing.assert_array_equal(new_img[:, :20, :30], img.transpose(2, 0, 1))
+    assert not new_img[:, 20:].any() and not new_img[:, :, 30:].any()
+    mask = target['mask']
+    assert mask.dtype == np.uint8 and mask.shape == (32, 40)
+    assert not mask[:20, :30].any() and mask[20:].all() and mask[:, 30:].all()
+    assert target['size'] == (32, 40)
+
+
+def test_pad_float_normalized():
+    img = random_image(np.random.RandomState(1), 20, 30)
+    mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    new_img, _ = Pad(32, 40, mean=mean, std=std)(img, {})
+    expected = (img / 255. - np.array(mean)) / np.array(std)
+    assert new_img.dtype == np.float32
+    np.testing.assert_allclose(new_img[:, :20, :30], expected.transpose(2, 0, 1), atol=1e-5)
+    assert not new_img[:, 20:].any() and not new_img[:, :, 30:].any()
+
+
+@pytest.mark.parametrize('make_pad', [
+    lambda **kwargs: Pad(32, 40, **kwargs),
+    lambda **kwargs: DynamicPad(40, stride=8, **kwargs),
+    lambda **kwargs: BucketPad([(32, 40), (16, 16), (40, 16)], **kwargs),
+])
+def test_arena_matches_fresh_buffers(make_pad):
+    rng = np.random.RandomState(2)
+    fresh, reused = make_pad(), make_pad(arena=BufferArena())
+    for h, w in SIZES * 2:
+        img = random_image(rng, h, w)
+        expected_img, expected_target = fresh(img, {})
+        # the pipeline copies the row before the worker produces the next one
+        new_img, target = reused(img, {})
+        np.testing.assert_array_equal(new_img, expected_img)
+        np.testing.assert_array_equal(target['mask'], expected_target['mask'])
+        assert target['size'] == expected_target['size']
+
+
+def test_dynamic_pad_size():
+    pad = DynamicPad(100, stride=32)
+    assert pad.pad_size(20, 30) == (32, 32)
+    assert pad.pad_size(33, 64) == (64, 64)
+    assert pad.pad_size(90, 99) == (96, 100)
+    # images larger than max_size are not cropped
+    assert pad.pad_size(130, 10) == (130, 32)
+
+
+def test_bucket_pad_size():
+    pad = BucketPad([(64, 64), (32, 48), (48, 32)])
+    assert pad.pad_size(20, 40) == (32, 48)
+    assert pad.pad_size(40, 20) == (48, 32)
+    assert pad.pad_size(40, 40) == (64, 64)
+    with pytest.raises(ValueError):
+        pad.pad_size(65, 10)
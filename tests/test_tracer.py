@@ -0,0 +1,61 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tracer records the selected steps only and stops the profiler at the end of the range."""
+
+import json
+import os
+
+from src.tools import tracer as tracer_module
+from src.tools.tracer import Tracer
+
+
+class Profiler(object):
+    def __init__(self):
+        self.calls = []
+
+    def start(self):
+        self.calls.append('start')
+
+    def stop(self):
+        self.calls.append('stop')
+
+    def analyse(self):
+        self.calls.append('analyse')
+
+
+def test_step_range_and_profiler(tmp_path):
+    tracer = Tracer(os.path.join(str(tmp_path), 'trace.json'), 2, 4)
+    tracer.profiler = profiler = Profiler()
+    tracer.profile_dir = str(tmp_path)
+    tracer_module.set_tracer(tracer)
+    try:
+        for step in range(6):
+            tracer.step(step)
+            with tracer_module.span('step', 'train', step=step):
+                pass
+            if step == 4:
+                # the profiler stops with the step range, the host spans of begin() are still recorded
+                assert profiler.calls == ['start', 'stop']
+        tracer.begin()
+        with tracer_module.span('coco_eval', 'eval'):
+            pass
+        tracer.close()
+    finally:
+        tracer_module.set_tracer(None)
+
+    assert profiler.calls == ['start', 'stop', 'analyse']
+    with open(tracer.path) as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    assert [e['name'] for e in events] == ['step', 'step', 'coco_eval']
+    assert [e['args']['step'] for e in events[:2]] == [2, 3]